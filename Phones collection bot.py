@@ -4,18 +4,40 @@ import asyncio
 import logging
 import random
 import json
-from datetime import datetime, timedelta
+import functools
+import math
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from fractions import Fraction
+from types import MappingProxyType
 from typing import Optional
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from aiogram.methods import TelegramMethod
+from aiogram.types import (InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton,
+                           FSInputFile)
+from aiogram.exceptions import (TelegramAPIError, TelegramBadRequest, TelegramForbiddenError,
+                                TelegramNetworkError, TelegramRetryAfter)
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from dotenv import load_dotenv
 
+try:
+    import numpy as np
+except ImportError:  # numpy нужен только для пакетных розыгрышей
+    np = None
+
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO)
@@ -24,63 +46,55 @@ logger = logging.getLogger(__name__)
 # ТОКЕНЫ
 BOT_TOKEN = os.getenv('PHONES_BOT_TOKEN', '')
 ADMIN_IDS = [int(x) for x in os.getenv('ADMIN_IDS', '').split(',') if x]
+DB_PATH = os.getenv('PHONES_BOT_DB', 'phones_bot.db')
+
+# ВЕБХУК (режим --webhook)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_CONCURRENCY = int(os.getenv('WEBHOOK_CONCURRENCY', '64'))
+WEBHOOK_MAX_PENDING = int(os.getenv('WEBHOOK_MAX_PENDING', '256'))
+# Сколько секунд при остановке ждать начатые апдейты
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '25'))
+# ПОЛЛИНГ: сколько апдейтов обрабатывается одновременно
+POLLING_CONCURRENCY = int(os.getenv('POLLING_CONCURRENCY', '64'))
+POLLING_TIMEOUT = 30
 
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
 
-RARITIES = {
-    0: {'name': '📱 Шифротребность', 'color': '⬜️', 'chance': 40.0, 'upgrade_chance': 50.0},
-    1: {'name': '📱 Необычный', 'color': '🟦', 'chance': 30.0, 'upgrade_chance': 40.0},
-    2: {'name': '⭐ Редкий', 'color': '🟧', 'chance': 15.0, 'upgrade_chance': 30.0},
-    3: {'name': '✨ Мистический', 'color': '🟪', 'chance': 8.0, 'upgrade_chance': 20.0},
-    4: {'name': '💎 Хроматический', 'color': '🟥', 'chance': 5.0, 'upgrade_chance': 10.0},
-    5: {'name': '🏆 Аркана', 'color': '🟨', 'chance': 1.8, 'upgrade_chance': 5.0},
-    6: {'name': '🎨 Раритет', 'color': '🟩', 'chance': 0.19, 'upgrade_chance': 2.0},
-    7: {'name': '🌟 Легенда', 'color': '⬛️', 'chance': 0.01, 'upgrade_chance': 0.0},
-}
-
-PHONES_DB = {
-    0: {
-        "Apple iPhone 3G": 800, "Apple iPhone 4": 900, "Apple iPhone 5c": 1200,
-        "Apple iPhone 7": 2000, "Samsung Galaxy S4": 800, "Samsung Galaxy Note 4": 1500,
-        "HTC One M7": 1000, "Sony Xperia Z": 1000, "Xiaomi Redmi 1S": 850,
-    },
-    1: {
-        "Apple iPhone 5": 3000, "Apple iPhone 6": 4000, "Apple iPhone 6s": 4900,
-        "Apple iPhone 8": 4500, "Samsung Galaxy S7": 3500, "Xiaomi Redmi Note 5": 3500,
-        "OnePlus 6": 4000, "Google Pixel 3a": 3500,
-    },
-    2: {
-        "Apple iPhone X": 10000, "Apple iPhone 11": 11500, "Apple iPhone 12": 16890,
-        "Apple iPhone 13": 20000, "Samsung Galaxy S9": 10000, "OnePlus 7 Pro": 10000,
-        "Xiaomi Mi 11": 10000, "Google Pixel 6": 12000,
-    },
-    3: {
-        "Apple iPhone 13 Pro": 35000, "Apple iPhone 14": 30000, "Apple iPhone 15": 53000,
-        "Samsung Galaxy S22 Ultra": 55000, "Xiaomi Mi 11 Ultra": 31000,
-        "OnePlus 9 Pro": 31000, "Google Pixel 7 Pro": 53000,
-    },
-    4: {
-        "Apple iPhone 14 Pro Max": 95000, "Apple iPhone 16": 85000,
-        "Samsung Galaxy S23 Ultra": 105000, "Xiaomi 13 Ultra": 110000,
-        "Google Pixel 8 Pro": 85000, "OnePlus 12": 80000,
-    },
-    5: {
-        "Apple iPhone 15 Pro Max": 200000, "Apple iPhone 16 Pro Max": 230000,
-        "Samsung Galaxy S25 Ultra": 215000, "Xiaomi 15 Ultra": 220000,
-        "OnePlus 13": 200000, "Google Pixel 9 Pro XL": 200000,
-    },
-    6: {
-        "Xiaomi Mi Mix Alpha": 500000, "Samsung K Zoom": 500000,
-        "Яндекс.Телефон": 500000, "Nokia 3310": 500000,
-        "Apple iPhone 5s Gold Edition": 500000,
-    },
-    7: {
-        "Apple iPhone 9": 3000000, "Nokia Lumia McLaren": 3000000,
-        "Google Project Ara": 3000000, "Nokia 888 Concept": 3000000,
-    }
-}
+# Каталог редкостей и моделей; RARITIES, PHONES_DB, MODELS и sampler заполняются из него в разделе КАТАЛОГ
+CATALOG_PATH = os.getenv('PHONES_CATALOG', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog.json'))
+
+
+BOT_COMMANDS = [
+    types.BotCommand(command="start", description="Приветственное сообщение"),
+    types.BotCommand(command="tcard", description="Получить карточку"),
+    types.BotCommand(command="tacc", description="Профиль и статистика"),
+    types.BotCommand(command="myphones", description="Мои телефоны"),
+    types.BotCommand(command="shop", description="Магазин телефонов"),
+    types.BotCommand(command="upgradeshop", description="Магазин улучшений"),
+    types.BotCommand(command="upgrade", description="Апгрейд телефона"),
+    types.BotCommand(command="daily", description="Ежедневная награда"),
+    types.BotCommand(command="top", description="Таблица лидеров"),
+    types.BotCommand(command="pay", description="Передать ТОчки"),
+    types.BotCommand(command="paycoin", description="Передать T-Coins"),
+    types.BotCommand(command="event", description="Текущий розыгрыш"),
+    types.BotCommand(command="sellall", description="Продать все телефоны"),
+    types.BotCommand(command="trade", description="Начать обмен"),
+    types.BotCommand(command="avito", description="Вторичный рынок"),
+    types.BotCommand(command="tfarm", description="Майнинг ферма"),
+    types.BotCommand(command="achievements", description="Достижения"),
+    types.BotCommand(command="donate", description="Каталог доната"),
+    types.BotCommand(command="roulette", description="Рулетка"),
+    types.BotCommand(command="tconfig", description="Настройки"),
+    types.BotCommand(command="tinfo", description="Информация"),
+    types.BotCommand(command="ping", description="Проверка связи"),
+]
+
+# Профиль бота (username, id), один раз загружается в bootstrap()
+bot_profile: Optional[types.User] = None
 
 
 class BotStates(StatesGroup):
@@ -92,10 +106,416 @@ class BotStates(StatesGroup):
     admin_broadcast = State()
 
 
-def init_db():
-    conn = sqlite3.connect('phones_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('''
+# ==================== РЕЙТИНГ ====================
+
+class _SkipNode:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, level: int):
+        self.key = key
+        self.next = [None] * level
+        self.width = [1] * level
+
+
+class IndexableSkipList:
+    """Skip list с ширинами ссылок: вставка, удаление и поиск позиции за O(log n)"""
+
+    MAX_LEVEL = 24
+    _END = (float('inf'),)
+
+    def __init__(self):
+        self._tail = _SkipNode(self._END, 0)
+        self._head = _SkipNode(None, self.MAX_LEVEL)
+        self._head.next = [self._tail] * self.MAX_LEVEL
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _random_level(self) -> int:
+        level = 1
+        while level < self.MAX_LEVEL and random.random() < 0.5:
+            level += 1
+        return level
+
+    def insert(self, key):
+        chain = [None] * self.MAX_LEVEL
+        steps_at_level = [0] * self.MAX_LEVEL
+        node = self._head
+        for level in reversed(range(self.MAX_LEVEL)):
+            while node.next[level].key <= key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        height = self._random_level()
+        new_node = _SkipNode(key, height)
+        steps = 0
+        for level in range(height):
+            prev = chain[level]
+            new_node.next[level] = prev.next[level]
+            prev.next[level] = new_node
+            new_node.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(height, self.MAX_LEVEL):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain = [None] * self.MAX_LEVEL
+        node = self._head
+        for level in reversed(range(self.MAX_LEVEL)):
+            while node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        target = chain[0].next[0]
+        if target.key != key:
+            raise KeyError(key)
+        for level in range(len(target.next)):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(len(target.next), self.MAX_LEVEL):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def index(self, key) -> int:
+        """Позиция ключа, начиная с 0"""
+        position = 0
+        node = self._head
+        for level in reversed(range(self.MAX_LEVEL)):
+            while node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+        if node.next[0].key != key:
+            raise KeyError(key)
+        return position
+
+    def head(self, count: int):
+        keys = []
+        node = self._head.next[0]
+        while node is not self._tail and len(keys) < count:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+
+class Leaderboard:
+    """Рейтинг и счётчики игроков в памяти: загружаются из users один раз и
+    меняются вместе с каждым изменением очков, карточек и телефонов, так что
+    топ, место игрока и его баланс не трогают SQLite. Изменения применяются
+    сразу, даже если в базу они попадут позже через write_behind.
+
+    Обновления приходят и из event loop, и из потока-писателя БД,
+    поэтому всё под одним коротким замком.
+    """
+
+    def __init__(self):
+        self._ranking = IndexableSkipList()
+        self._users = {}  # user_id -> [points, first_name, username, total_phones, cards]
+        self._lock = threading.Lock()
+
+    def load(self, rows):
+        """rows: (user_id, first_name, username, points, total_phones, cards)"""
+        with self._lock:
+            self._ranking = IndexableSkipList()
+            self._users = {}
+            for user_id, first_name, username, points, total_phones, cards in rows:
+                self._users[user_id] = [points, first_name, username, total_phones, cards]
+                self._ranking.insert((-points, user_id))
+
+    def add_user(self, user_id: int, first_name: str, username: str, points: int, total_phones: int, cards: int):
+        with self._lock:
+            if user_id not in self._users:
+                self._users[user_id] = [points, first_name, username, total_phones, cards]
+                self._ranking.insert((-points, user_id))
+
+    def add(self, user_id: int, points: int = 0, total_phones: int = 0, cards: int = 0):
+        """Приращения счётчиков игрока"""
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return
+            if points:
+                self._ranking.remove((-entry[0], user_id))
+                entry[0] += points
+                self._ranking.insert((-entry[0], user_id))
+            entry[3] += total_phones
+            entry[4] += cards
+
+    def counters(self, user_id: int):
+        """(points, cards, total_phones) или None, если игрок не загружен"""
+        with self._lock:
+            entry = self._users.get(user_id)
+            return (entry[0], entry[4], entry[3]) if entry else None
+
+    def rank(self, user_id: int) -> Optional[int]:
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return None
+            return self._ranking.index((-entry[0], user_id)) + 1
+
+    def top(self, count: int = 10):
+        """[(user_id, first_name, username, points, total_phones), ...]"""
+        with self._lock:
+            leaders = []
+            for _, user_id in self._ranking.head(count):
+                points, first_name, username, total_phones, _ = self._users[user_id]
+                leaders.append((user_id, first_name, username, points, total_phones))
+            return leaders
+
+
+ranking = Leaderboard()
+
+
+class WriteBehind:
+    """Копит приращения счётчиков users (points, cards, total_phones) в памяти
+    и сбрасывает их одной транзакцией раз в flush_interval секунд или после
+    max_ops изменений - вместо отдельного коммита и fsync на каждое действие.
+
+    Новые значения сразу видны через ranking, поэтому баланс в ответах
+    не отстаёт от базы. Перед остановкой бота очередь обязательно сбрасывается.
+
+    ТОчки сюда намеренно не ставятся: списание должно проверить баланс условным
+    UPDATE в той же транзакции, поэтому все изменения ТОчек идут через
+    change_balance. Колонка points остаётся для приращений, которые
+    change_balance забирает вместе с остальными.
+    """
+
+    def __init__(self, flush_interval: float = 0.05, max_ops: int = 500):
+        self.flush_interval = flush_interval
+        self.max_ops = max_ops
+        self._pending = {}  # user_id -> [points, cards, total_phones]
+        self._ops = 0
+        self._lock = threading.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.flushed_ops = 0
+
+    def add(self, user_id: int, points: int = 0, cards: int = 0, total_phones: int = 0):
+        """Можно вызывать из любого потока"""
+        ranking.add(user_id, points=points, total_phones=total_phones, cards=cards)
+        with self._lock:
+            deltas = self._pending.setdefault(user_id, [0, 0, 0])
+            deltas[0] += points
+            deltas[1] += cards
+            deltas[2] += total_phones
+            self._ops += 1
+            full = self._ops >= self.max_ops
+        if full and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def take(self, user_id: int):
+        """Забирает ещё не записанные приращения игрока, чтобы применить их
+        в своей транзакции. Возвращает [points, cards, total_phones] или None"""
+        with self._lock:
+            return self._pending.pop(user_id, None)
+
+    def restore(self, user_id: int, deltas):
+        """Возвращает в очередь приращения, взятые через take(), если транзакция не прошла"""
+        if not deltas:
+            return
+        with self._lock:
+            pending = self._pending.setdefault(user_id, [0, 0, 0])
+            for i, delta in enumerate(deltas):
+                pending[i] += delta
+
+    async def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            ops, self._ops = self._ops, 0
+        if not batch:
+            return
+        try:
+            await apply_counter_deltas(batch)
+        except Exception:
+            for user_id, deltas in batch.items():
+                self.restore(user_id, deltas)
+            with self._lock:
+                self._ops += ops
+            raise
+        self.flushes += 1
+        self.flushed_ops += ops
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("💾 Не удалось сбросить очередь счётчиков, повторю позже")
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+write_behind = WriteBehind()
+
+
+# ==================== КУЛДАУНЫ ====================
+
+CARD_COOLDOWN = 3 * 3600
+DAILY_COOLDOWN = 24 * 3600
+
+
+class CooldownIndex:
+    """user_id -> epoch, с которого снова можно получить карточку/награду.
+
+    Заполняется при первой попытке игрока и обновляется при выдаче, так что
+    повторные "тк" во время кулдауна отвечаются без обращения к базе.
+    Сама выдача всё равно проверяет кулдаун условным UPDATE.
+
+    Хранятся только идущие кулдауны: истёкшая запись удаляется при чтении,
+    а раз в sweep_interval секунд - все истёкшие, включая игроков, которые
+    больше не приходили.
+    """
+
+    def __init__(self, sweep_interval: int = 600):
+        self._ready = {}
+        self.sweep_interval = sweep_interval
+        self._swept_at = 0
+
+    def __len__(self) -> int:
+        return len(self._ready)
+
+    def remaining(self, user_id: int, now: int) -> int:
+        """Сколько секунд ждать; 0 - кулдаун прошёл или игрок ещё не известен"""
+        if now - self._swept_at >= self.sweep_interval:
+            self.sweep(now)
+        ready_at = self._ready.get(user_id)
+        if ready_at is None:
+            return 0
+        if ready_at <= now:
+            del self._ready[user_id]
+            return 0
+        return ready_at - now
+
+    def set(self, user_id: int, ready_at: int):
+        self._ready[user_id] = ready_at
+
+    def sweep(self, now: int):
+        self._ready = {user_id: ready_at for user_id, ready_at in self._ready.items() if ready_at > now}
+        self._swept_at = now
+
+
+card_cooldowns = CooldownIndex()
+daily_cooldowns = CooldownIndex()
+
+
+# ==================== БАЗА ДАННЫХ ====================
+
+class Database:
+    """Долгоживущие подключения к SQLite в режиме WAL, вынесенные из event loop.
+
+    Все записи идут через один поток-писатель (SQLite всё равно допускает
+    только одного писателя), чтения - через небольшой пул потоков, у каждого
+    из которых своё подключение. Хендлеры только await-ят результат.
+    """
+
+    PRAGMAS = (
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA cache_size = -65536",
+        "PRAGMA mmap_size = 268435456",
+        "PRAGMA temp_store = MEMORY",
+        "PRAGMA busy_timeout = 5000",
+    )
+
+    def __init__(self, path: str, readers: int = 4, cached_statements: int = 256):
+        self.path = path
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+
+    def _connect(self, read_only: bool) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # sqlite3 кэширует подготовленные выражения по тексту SQL,
+            # поэтому одинаковые запросы не парсятся повторно
+            conn = sqlite3.connect(self.path, cached_statements=self.cached_statements,
+                                   check_same_thread=False)
+            for pragma in self.PRAGMAS:
+                conn.execute(pragma)
+            if read_only:
+                conn.execute("PRAGMA query_only = ON")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _run_read(self, fn, args, kwargs):
+        return fn(self._connect(read_only=True), *args, **kwargs)
+
+    def _run_write(self, fn, args, kwargs):
+        conn = self._connect(read_only=False)
+        with conn:
+            return fn(conn, *args, **kwargs)
+
+    async def read(self, fn, *args, **kwargs):
+        """Выполнить fn(conn, ...) в потоке-читателе"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._run_read, fn, args, kwargs)
+
+    async def write(self, fn, *args, **kwargs):
+        """Выполнить fn(conn, ...) в потоке-писателе одной транзакцией"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, self._run_write, fn, args, kwargs)
+
+    def reader(self, fn):
+        """Декоратор: def f(conn, ...) -> async def f(...), выполняется в потоке-читателе"""
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            return await self.read(fn, *args, **kwargs)
+        return wrapper
+
+    def writer(self, fn):
+        """Декоратор: def f(conn, ...) -> async def f(...), выполняется в потоке-писателе"""
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            return await self.write(fn, *args, **kwargs)
+        return wrapper
+
+    async def sync(self):
+        """Дожидается записей, уже поставленных в очередь писателя"""
+        await self.write(lambda conn: None)
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+db = Database(DB_PATH)
+
+
+@db.writer
+def init_db(conn):
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -110,7 +530,7 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS user_phones (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -121,7 +541,7 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users (user_id)
         )
     ''')
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS achievements (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -131,93 +551,1325 @@ def init_db():
         )
     ''')
     conn.commit()
-    conn.close()
+    run_migrations(conn)
 
 
-def create_user(user_id: int, username: str, first_name: str):
-    conn = sqlite3.connect('phones_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR IGNORE INTO users (user_id, username, first_name) VALUES (?, ?, ?)',
-                   (user_id, username, first_name))
-    conn.commit()
-    conn.close()
+# ==================== МИГРАЦИИ ====================
+
+MIGRATIONS = []
+
 
+def migration(fn):
+    """Регистрирует следующую миграцию схемы; её версия - порядковый номер в MIGRATIONS"""
+    MIGRATIONS.append(fn)
+    return fn
+
+
+def run_migrations(conn):
+    """Применяет миграции новее PRAGMA user_version, каждую в своей транзакции"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, fn in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute('BEGIN')
+        fn(conn)
+        conn.execute(f'PRAGMA user_version = {number}')
+        conn.commit()
+        logger.info(f"🗄 Миграция #{number} ({fn.__name__}) применена")
+
+
+@migration
+def index_user_phones(conn):
+    # Страницы "Мои телефоны" и массовый апгрейд: WHERE user_id = ? AND rarity = ? ORDER BY price
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_user_phones_owner '
+                 'ON user_phones (user_id, rarity, price DESC)')
+
+
+@migration
+def index_users(conn):
+    # /pay, /trade, /avito ищут по username, таблица лидеров сортирует по points
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_points ON users (points DESC)')
+
+
+@migration
+def create_user_collection(conn):
+    # Количество и суммарная стоимость телефонов по (игрок, редкость):
+    # профиль читает несколько чисел вместо всей коллекции
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_collection (
+            user_id INTEGER NOT NULL,
+            rarity INTEGER NOT NULL,
+            phones INTEGER NOT NULL DEFAULT 0,
+            total_value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, rarity)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        INSERT INTO user_collection (user_id, rarity, phones, total_value)
+        SELECT user_id, rarity, COUNT(*), SUM(price) FROM user_phones GROUP BY user_id, rarity
+    ''')
+
+
+@migration
+def create_media_cache(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS media_cache (
+            key TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+@migration
+def create_fsm_storage(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at INTEGER NOT NULL
+        )
+    ''')
 
-def get_user(user_id: int):
-    conn = sqlite3.connect('phones_bot.db')
+
+@migration
+def create_broadcasts(conn):
+    # Рассылка копирует сообщение админа (from_chat_id, message_id) всем игрокам;
+    # cursor - последний обработанный user_id, чтобы после перезапуска продолжить с него
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY,
+            admin_id INTEGER NOT NULL,
+            from_chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            cursor INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS blocked_users (
+            user_id INTEGER PRIMARY KEY,
+            blocked_at INTEGER NOT NULL
+        )
+    ''')
+
+
+@migration
+def add_epoch_cooldowns(conn):
+    # Кулдауны как целые секунды epoch вместо ISO-строк: проверка без разбора дат
+    conn.execute('ALTER TABLE users ADD COLUMN last_card_at INTEGER')
+    conn.execute('ALTER TABLE users ADD COLUMN last_daily_at INTEGER')
+    rows = conn.execute('SELECT user_id, last_card, last_daily FROM users '
+                        'WHERE last_card IS NOT NULL OR last_daily IS NOT NULL').fetchall()
+    conn.executemany('UPDATE users SET last_card_at = ?, last_daily_at = ? WHERE user_id = ?', [
+        (int(datetime.fromisoformat(last_card).timestamp()) if last_card else None,
+         int(datetime.fromisoformat(last_daily).timestamp()) if last_daily else None,
+         user_id)
+        for user_id, last_card, last_daily in rows
+    ])
+
+
+@migration
+def drop_iso_cooldowns(conn):
+    # Кулдауны перенесены в last_card_at/last_daily_at, ISO-строки больше не нужны
+    conn.execute('ALTER TABLE users DROP COLUMN last_card')
+    conn.execute('ALTER TABLE users DROP COLUMN last_daily')
+
+
+@migration
+def normalize_user_phones(conn):
+    # Вместо имени модели - её id из каталога: строки и индекс меньше, имя берётся из каталога.
+    # price остаётся - это стоимость телефона при получении, на ней держатся
+    # продажа, user_collection и keyset-страницы по idx_user_phones_owner
+    conn.execute('CREATE TEMP TABLE catalog_models (rarity INTEGER, name TEXT, model_id INTEGER, '
+                 'PRIMARY KEY (rarity, name))')
+    conn.executemany('INSERT INTO catalog_models VALUES (?, ?, ?)',
+                     [(model.rarity, model.name, model.id) for model in MODELS.values()])
+    unknown = conn.execute('''SELECT DISTINCT p.rarity, p.phone_name FROM user_phones p
+                              LEFT JOIN catalog_models m ON m.rarity = p.rarity AND m.name = p.phone_name
+                              WHERE m.model_id IS NULL''').fetchall()
+    if unknown:
+        raise CatalogError(f"у телефонов игроков есть модели не из каталога, добавьте их с \"retired\": true: {unknown}")
+    sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'user_phones'").fetchone()
+    conn.execute('''
+        CREATE TABLE user_phones_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            model_id INTEGER NOT NULL,
+            rarity INTEGER,
+            price INTEGER,
+            obtained_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+    conn.execute('''INSERT INTO user_phones_new (id, user_id, model_id, rarity, price, obtained_at)
+                    SELECT p.id, p.user_id, m.model_id, p.rarity, p.price, p.obtained_at FROM user_phones p
+                    JOIN catalog_models m ON m.rarity = p.rarity AND m.name = p.phone_name''')
+    conn.execute('DROP TABLE catalog_models')
+    conn.execute('DROP TABLE user_phones')
+    conn.execute('ALTER TABLE user_phones_new RENAME TO user_phones')
+    # id проданных телефонов не выдаются заново: на них ещё могут ссылаться старые кнопки
+    if sequence:
+        conn.execute("DELETE FROM sqlite_sequence WHERE name = 'user_phones'")
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('user_phones', ?)", sequence)
+    conn.execute('CREATE INDEX idx_user_phones_owner ON user_phones (user_id, rarity, price DESC)')
+
+
+@migration
+def add_fsm_versions(conn):
+    # Версия записи FSM растёт при каждом изменении: по ней кэш процесса
+    # замечает, что состояние поменял другой процесс
+    conn.execute('ALTER TABLE fsm_storage ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+
+
+# ==================== МОДЕЛИ ====================
+
+class User:
+    """Игрок: только колонки users, которые нужны хендлерам"""
+    __slots__ = ('user_id', 'username', 'first_name', 'points', 'cards', 'total_phones', 'farm_income')
+    COLUMNS = ', '.join(__slots__)
+
+    def __init__(self, user_id, username, first_name, points, cards, total_phones, farm_income):
+        self.user_id = user_id
+        self.username = username
+        self.first_name = first_name
+        self.points = points
+        self.cards = cards
+        self.total_phones = total_phones
+        self.farm_income = farm_income
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        return cls(*row)
+
+
+class OwnedPhone:
+    """Телефон в коллекции игрока; имя модели берётся из каталога по model_id"""
+    __slots__ = ('id', 'model_id', 'rarity', 'price')
+    COLUMNS = ', '.join(__slots__)
+
+    def __init__(self, id, model_id, rarity, price):
+        self.id = id
+        self.model_id = model_id
+        self.rarity = rarity
+        self.price = price
+
+    @property
+    def phone_name(self) -> str:
+        return model_name(self.model_id)
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        return cls(*row)
+
+
+def query(conn, model, sql: str, params=()):
+    """Выполняет sql и отдаёт строки как объекты model"""
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-    user = cursor.fetchone()
-    conn.close()
+    cursor.row_factory = model.from_row
+    return cursor.execute(sql, params)
+
+
+def adjust_collection(conn, user_id: int, rarity: int, phones: int, value: int):
+    """Изменяет агрегаты коллекции в текущей транзакции"""
+    conn.execute('''INSERT INTO user_collection (user_id, rarity, phones, total_value) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (user_id, rarity) DO UPDATE SET
+                        phones = phones + excluded.phones,
+                        total_value = total_value + excluded.total_value''',
+                 (user_id, rarity, phones, value))
+
+
+@db.writer
+def create_user(conn, user_id: int, username: str, first_name: str):
+    created = conn.execute('''INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)
+                              ON CONFLICT (user_id) DO NOTHING
+                              RETURNING points, total_phones, cards''', (user_id, username, first_name)).fetchone()
+    if created:
+        ranking.add_user(user_id, first_name, username, *created)
+    # Игрок снова написал боту - значит, разблокировал его
+    conn.execute('DELETE FROM blocked_users WHERE user_id = ?', (user_id,))
+
+
+@db.reader
+def load_user(conn, user_id: int) -> Optional[User]:
+    return query(conn, User, f'SELECT {User.COLUMNS} FROM users WHERE user_id = ?', (user_id,)).fetchone()
+
+
+async def get_user(user_id: int) -> Optional[User]:
+    """Игрок с учётом ещё не записанных приращений points/cards/total_phones"""
+    user = await load_user(user_id)
+    counters = ranking.counters(user_id)
+    if user and counters:
+        user.points, user.cards, user.total_phones = counters
     return user
 
 
-def update_points(user_id: int, amount: int):
-    conn = sqlite3.connect('phones_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET points = points + ? WHERE user_id = ?', (amount, user_id))
-    conn.commit()
-    conn.close()
+async def get_points(user_id: int) -> int:
+    counters = ranking.counters(user_id)
+    if counters:
+        return counters[0]
+    user = await load_user(user_id)
+    return user.points if user else 0
 
 
-def get_points(user_id: int) -> int:
-    user = get_user(user_id)
-    return user[3] if user else 0
+@db.writer
+def apply_counter_deltas(conn, batch):
+    """batch: {user_id: [points, cards, total_phones]} - одной транзакцией"""
+    conn.executemany('''UPDATE users SET points = points + ?, cards = cards + ?, total_phones = total_phones + ?
+                        WHERE user_id = ?''',
+                     [(points, cards, total_phones, user_id)
+                      for user_id, (points, cards, total_phones) in batch.items()])
 
 
-def add_phone(user_id: int, phone_name: str, rarity: int, price: int):
-    conn = sqlite3.connect('phones_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('''INSERT INTO user_phones (user_id, phone_name, rarity, price)
-                      VALUES (?, ?, ?, ?)''', (user_id, phone_name, rarity, price))
-    cursor.execute('UPDATE users SET total_phones = total_phones + 1 WHERE user_id = ?', (user_id,))
-    phone_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+def insert_phone(conn, user_id: int, model: 'PhoneModel') -> int:
+    """Телефон модели model и строка коллекции; total_phones меняет вызывающий"""
+    phone_id = conn.execute('''INSERT INTO user_phones (user_id, model_id, rarity, price)
+                               VALUES (?, ?, ?, ?)''', (user_id, model.id, model.rarity, model.price)).lastrowid
+    adjust_collection(conn, user_id, model.rarity, 1, model.price)
     return phone_id
 
 
-def get_user_phones(user_id: int, rarity: int = None):
-    conn = sqlite3.connect('phones_bot.db')
-    cursor = conn.cursor()
-    if rarity is not None:
-        cursor.execute('SELECT * FROM user_phones WHERE user_id = ? AND rarity = ? ORDER BY price DESC',
-                       (user_id, rarity))
+def change_balance(conn, user_id: int, amount: int, total_phones: int = 0) -> Optional[int]:
+    """Условное изменение баланса: списание проходит, только если ТОчек хватает.
+    Заодно записывает накопленные в write_behind приращения игрока, чтобы
+    проверка шла по актуальному балансу. Возвращает новый баланс или None.
+
+    Должен быть последним запросом транзакции: при отказе вызывающий
+    откатывает её целиком, а взятые приращения возвращаются в очередь.
+    """
+    pending = write_behind.take(user_id) or [0, 0, 0]
+    points = pending[0] + amount
+    try:
+        row = conn.execute('''UPDATE users SET points = points + ?, cards = cards + ?, total_phones = total_phones + ?
+                              WHERE user_id = ? AND points + ? >= 0 RETURNING points''',
+                           (points, pending[1], pending[2] + total_phones, user_id, points)).fetchone()
+    except Exception:
+        write_behind.restore(user_id, pending)
+        raise
+    if row is None:
+        write_behind.restore(user_id, pending)
+        return None
+    ranking.add(user_id, points=amount, total_phones=total_phones)
+    return row[0]
+
+
+@db.writer
+def grant_card(conn, user_id: int, model: 'PhoneModel', now: int):
+    """Выдача карточки, если кулдаун прошёл: время получения и телефон одной транзакцией,
+    счётчики - через write_behind. Возвращает (phone_id или None, когда можно снова) или
+    (None, None), если игрока нет"""
+    granted = conn.execute('''UPDATE users SET last_card_at = ?
+                              WHERE user_id = ? AND COALESCE(last_card_at, 0) <= ? RETURNING user_id''',
+                           (now, user_id, now - CARD_COOLDOWN)).fetchone()
+    if not granted:
+        row = conn.execute('SELECT last_card_at FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        return None, (row[0] + CARD_COOLDOWN if row else None)
+    phone_id = insert_phone(conn, user_id, model)
+    write_behind.add(user_id, cards=1, total_phones=1)
+    return phone_id, now + CARD_COOLDOWN
+
+
+@db.writer
+def buy_phone(conn, user_id: int, model: 'PhoneModel'):
+    """Покупка одной транзакцией. Возвращает (phone_id, баланс) или None, если не хватает ТОчек"""
+    phone_id = insert_phone(conn, user_id, model)
+    balance = change_balance(conn, user_id, -model.price, total_phones=1)
+    if balance is None:
+        conn.rollback()
+        return None
+    return phone_id, balance
+
+
+@db.writer
+def transfer_points(conn, user_id: int, target_id: int, amount: int) -> Optional[int]:
+    """Перевод ТОчек. Возвращает новый баланс отправителя или None, если не хватает ТОчек"""
+    conn.execute('UPDATE users SET points = points + ? WHERE user_id = ?', (amount, target_id))
+    balance = change_balance(conn, user_id, -amount)
+    if balance is None:
+        conn.rollback()
+        return None
+    ranking.add(target_id, points=amount)
+    return balance
+
+
+@db.reader
+def get_phones_page(conn, user_id: int, rarity: int, cursor=None, backward: bool = False, limit: int = 5):
+    """Keyset-страница телефонов редкости в порядке (price DESC, id).
+
+    cursor - (price, id) крайнего телефона соседней страницы: читаем limit+1
+    строк по индексу сразу от него, поэтому стоимость страницы не зависит
+    от размера коллекции. Возвращает (телефоны, есть ли предыдущая, есть ли следующая).
+    """
+    if cursor is None:
+        rows = query(conn, OwnedPhone, f'''SELECT {OwnedPhone.COLUMNS} FROM user_phones
+                                          WHERE user_id = ? AND rarity = ?
+                                          ORDER BY price DESC, id LIMIT ?''', (user_id, rarity, limit + 1)).fetchall()
+        return rows[:limit], False, len(rows) > limit
+    price, phone_id = cursor
+    if backward:
+        rows = query(conn, OwnedPhone, f'''SELECT {OwnedPhone.COLUMNS} FROM user_phones
+                                          WHERE user_id = ? AND rarity = ? AND price >= ? AND (price > ? OR id < ?)
+                                          ORDER BY price, id DESC LIMIT ?''',
+                     (user_id, rarity, price, price, phone_id, limit + 1)).fetchall()
+        return rows[:limit][::-1], len(rows) > limit, True
+    rows = query(conn, OwnedPhone, f'''SELECT {OwnedPhone.COLUMNS} FROM user_phones
+                                      WHERE user_id = ? AND rarity = ? AND price <= ? AND (price < ? OR id > ?)
+                                      ORDER BY price DESC, id LIMIT ?''',
+                 (user_id, rarity, price, price, phone_id, limit + 1)).fetchall()
+    return rows[:limit], True, len(rows) > limit
+
+
+@db.reader
+def get_user_phone(conn, phone_id: int, user_id: int) -> Optional[OwnedPhone]:
+    return query(conn, OwnedPhone, f'SELECT {OwnedPhone.COLUMNS} FROM user_phones WHERE id = ? AND user_id = ?',
+                 (phone_id, user_id)).fetchone()
+
+
+@db.writer
+def replace_phone(conn, phone_id: int, user_id: int, model: 'PhoneModel') -> bool:
+    """Успешный апгрейд: старый телефон заменяется новым, total_phones не меняется"""
+    old = conn.execute('DELETE FROM user_phones WHERE id = ? AND user_id = ? RETURNING rarity, price',
+                       (phone_id, user_id)).fetchone()
+    if not old:
+        return False
+    adjust_collection(conn, user_id, old[0], -1, -old[1])
+    insert_phone(conn, user_id, model)
+    return True
+
+
+@db.writer
+def destroy_phone(conn, phone_id: int, user_id: int) -> bool:
+    """Неудачный апгрейд: телефон теряется"""
+    old = conn.execute('DELETE FROM user_phones WHERE id = ? AND user_id = ? RETURNING rarity, price',
+                       (phone_id, user_id)).fetchone()
+    if not old:
+        return False
+    adjust_collection(conn, user_id, old[0], -1, -old[1])
+    conn.execute('UPDATE users SET total_phones = total_phones - 1 WHERE user_id = ?', (user_id,))
+    ranking.add(user_id, total_phones=-1)
+    return True
+
+
+@db.writer
+def upgrade_phones(conn, user_id: int, rarity: int, limit: Optional[int] = None):
+    """Массовый апгрейд: limit самых дешёвых телефонов редкости (или все) одной транзакцией.
+    Возвращает (попыток, улучшено, стоимость вложенных телефонов, стоимость полученных)"""
+    if limit is None:
+        limit = -1
+    old = conn.execute('''DELETE FROM user_phones WHERE id IN (
+                              SELECT id FROM user_phones WHERE user_id = ? AND rarity = ? ORDER BY price LIMIT ?
+                          ) RETURNING price''', (user_id, rarity, limit)).fetchall()
+    if not old:
+        return 0, 0, 0, 0
+    attempts = len(old)
+    spent = sum(price for price, in old)
+    adjust_collection(conn, user_id, rarity, -attempts, -spent)
+    # Один снимок каталога на всю транзакцию: перезагрузка может прийти из event loop
+    current = catalog
+    upgraded = sum(roll_upgrades(current.rarities[rarity]['upgrade_chance'], attempts))
+    new_phones = current.sampler.draw_models(rarity + 1, upgraded)
+    gained = sum(model.price for model in new_phones)
+    if upgraded:
+        conn.executemany('''INSERT INTO user_phones (user_id, model_id, rarity, price)
+                            VALUES (?, ?, ?, ?)''',
+                         [(user_id, model.id, model.rarity, model.price) for model in new_phones])
+        adjust_collection(conn, user_id, rarity + 1, upgraded, gained)
+    if attempts > upgraded:
+        conn.execute('UPDATE users SET total_phones = total_phones - ? WHERE user_id = ?',
+                     (attempts - upgraded, user_id))
+        ranking.add(user_id, total_phones=upgraded - attempts)
+    return attempts, upgraded, spent, gained
+
+
+@db.writer
+def sell_user_phone(conn, phone_id: int, user_id: int):
+    """Продажа за 75% стоимости. Возвращает (phone_name, rarity, sell_price, баланс) или None"""
+    phone = conn.execute('DELETE FROM user_phones WHERE id = ? AND user_id = ? RETURNING model_id, rarity, price',
+                         (phone_id, user_id)).fetchone()
+    if not phone:
+        return None
+    model_id, rarity, price = phone
+    adjust_collection(conn, user_id, rarity, -1, -price)
+    sell_price = int(price * 0.75)
+    balance = change_balance(conn, user_id, sell_price, total_phones=-1)
+    return model_name(model_id), rarity, sell_price, balance
+
+
+@db.writer
+def sell_all_phones(conn, user_id: int, rarity: Optional[int] = None):
+    """Продажа всех телефонов редкости (или всех редкостей) одним DELETE за 75% суммарной стоимости.
+    Возвращает (продано, получено ТОчек, баланс)"""
+    if rarity is None:
+        sold = conn.execute('DELETE FROM user_phones WHERE user_id = ? RETURNING rarity, price', (user_id,))
     else:
-        cursor.execute('SELECT * FROM user_phones WHERE user_id = ? ORDER BY rarity DESC, price DESC',
-                       (user_id,))
-    phones = cursor.fetchall()
-    conn.close()
-    return phones
+        sold = conn.execute('DELETE FROM user_phones WHERE user_id = ? AND rarity = ? RETURNING rarity, price',
+                            (user_id, rarity))
+    phones, value = Counter(), Counter()
+    for phone_rarity, price in sold:
+        phones[phone_rarity] += 1
+        value[phone_rarity] += price
+    count = sum(phones.values())
+    if not count:
+        return 0, 0, None
+    for phone_rarity, phone_count in phones.items():
+        adjust_collection(conn, user_id, phone_rarity, -phone_count, -value[phone_rarity])
+    sell_price = int(sum(value.values()) * 0.75)
+    balance = change_balance(conn, user_id, sell_price, total_phones=-count)
+    return count, sell_price, balance
+
+
+@db.writer
+def claim_daily(conn, user_id: int, reward: int, now: int):
+    """Ежедневная награда, если кулдаун прошёл. Возвращает (баланс или None, когда можно снова)
+    или (None, None), если игрока нет"""
+    claimed = conn.execute('''UPDATE users SET last_daily_at = ?
+                              WHERE user_id = ? AND COALESCE(last_daily_at, 0) <= ? RETURNING user_id''',
+                           (now, user_id, now - DAILY_COOLDOWN)).fetchone()
+    if not claimed:
+        row = conn.execute('SELECT last_daily_at FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        return None, (row[0] + DAILY_COOLDOWN if row else None)
+    return change_balance(conn, user_id, reward), now + DAILY_COOLDOWN
+
+
+@db.reader
+def find_user_by_username(conn, username: str):
+    return conn.execute('SELECT user_id, first_name FROM users WHERE username = ?', (username,)).fetchone()
+
+
+@db.reader
+def load_leaderboard(conn):
+    ranking.load(conn.execute(
+        'SELECT user_id, first_name, username, points, total_phones, cards FROM users'
+    ))
+
+
+@db.reader
+def get_collection(conn, user_id: int):
+    """{rarity: (телефонов, суммарная стоимость)} по агрегатам коллекции"""
+    return {rarity: (phones, value) for rarity, phones, value in conn.execute(
+        'SELECT rarity, phones, total_value FROM user_collection WHERE user_id = ? AND phones > 0', (user_id,)
+    )}
+
+
+@db.reader
+def check_collection(conn):
+    """Сверяет user_collection с user_phones. Возвращает расхождения
+    [(user_id, rarity, (phones, value) по факту, (phones, value) в агрегатах)]"""
+    actual = '''SELECT user_id, rarity, COUNT(*) AS phones, SUM(price) AS total_value
+                  FROM user_phones GROUP BY user_id, rarity'''
+    mismatches = conn.execute(f'''
+        SELECT a.user_id, a.rarity, a.phones, a.total_value, c.phones, c.total_value
+        FROM ({actual}) a LEFT JOIN user_collection c USING (user_id, rarity)
+        WHERE c.phones IS NOT a.phones OR c.total_value IS NOT a.total_value
+        UNION ALL
+        SELECT c.user_id, c.rarity, 0, 0, c.phones, c.total_value
+        FROM user_collection c
+        WHERE c.phones != 0 AND NOT EXISTS (
+            SELECT 1 FROM user_phones p WHERE p.user_id = c.user_id AND p.rarity = c.rarity)
+    ''').fetchall()
+    return [(user_id, rarity, (phones, value), (stored_phones or 0, stored_value or 0))
+            for user_id, rarity, phones, value, stored_phones, stored_value in mismatches]
+
+
+@db.writer
+def rebuild_collection(conn, user_ids):
+    """Пересчитывает агрегаты коллекции указанных игроков из user_phones"""
+    for user_id in user_ids:
+        conn.execute('DELETE FROM user_collection WHERE user_id = ?', (user_id,))
+        conn.execute('''INSERT INTO user_collection (user_id, rarity, phones, total_value)
+                        SELECT user_id, rarity, COUNT(*), SUM(price) FROM user_phones
+                        WHERE user_id = ? GROUP BY rarity''', (user_id,))
+
+
+@db.reader
+def get_bot_stats(conn):
+    """(пользователей, телефонов, всего ТОчек)"""
+    total_users, total_points = conn.execute('SELECT COUNT(*), COALESCE(SUM(points), 0) FROM users').fetchone()
+    total_phones = conn.execute('SELECT COUNT(*) FROM user_phones').fetchone()[0]
+    return total_users, total_phones, total_points
+
+
+# ==================== МЕДИА ====================
+
+MEDIA_DIR = os.getenv('PHONES_BOT_MEDIA', 'media')
+
+# Ключ -> (локальный файл, внешний URL). Локальный файл грузится, если он есть
+MEDIA = {
+    'welcome': (os.path.join(MEDIA_DIR, 'welcome.jpg'),
+                "https://i.postimg.cc/HsVQVsZQ/photo_2026_03_01_03_52_06.jpg"),
+}
 
 
-def delete_phone(phone_id: int):
-    conn = sqlite3.connect('phones_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM user_phones WHERE id = ?', (phone_id,))
-    conn.commit()
-    conn.close()
+@db.reader
+def load_media_file_ids(conn):
+    return dict(conn.execute('SELECT key, file_id FROM media_cache'))
 
 
-def get_random_phone(rarity: int):
-    phones = PHONES_DB.get(rarity, {})
-    if not phones:
-        return None, 0
-    phone_name = random.choice(list(phones.keys()))
-    price = phones[phone_name]
-    return phone_name, price
+@db.writer
+def save_media_file_id(conn, key: str, file_id: str):
+    conn.execute('''INSERT INTO media_cache (key, file_id) VALUES (?, ?)
+                    ON CONFLICT (key) DO UPDATE SET file_id = excluded.file_id,
+                                                    updated_at = CURRENT_TIMESTAMP''', (key, file_id))
+
+
+@db.writer
+def forget_media_file_id(conn, key: str):
+    conn.execute('DELETE FROM media_cache WHERE key = ?', (key,))
+
+
+class MediaCache:
+    """Кэш file_id отправленных фото: после первой отправки Telegram больше
+    не скачивает картинку с внешнего хостинга. Хранится в media_cache."""
+
+    def __init__(self, media):
+        self.media = media
+        self._file_ids = {}
+
+    async def load(self):
+        self._file_ids = await load_media_file_ids()
+
+    async def send_photo(self, bot: Bot, chat_id: int, key: str, **kwargs) -> types.Message:
+        file_id = self._file_ids.get(key)
+        if file_id:
+            try:
+                return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+            except TelegramBadRequest as e:
+                logger.warning(f"🖼 file_id для '{key}' отклонён ({e.message}), загружаю заново")
+                self._file_ids.pop(key, None)
+                await forget_media_file_id(key)
+        path, url = self.media[key]
+        photo = FSInputFile(path) if os.path.exists(path) else url
+        message = await bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+        if message.photo:
+            self._file_ids[key] = message.photo[-1].file_id
+            await save_media_file_id(key, self._file_ids[key])
+        return message
+
+
+media = MediaCache(MEDIA)
+
+
+# ==================== FSM ====================
+
+# Записи FSM не удаляются, даже опустев: иначе версия ключа начнётся заново
+# и кэш другого процесса может принять новую запись за ту, что он помнит.
+# version 0 - записи нет
+
+@db.reader
+def load_fsm_record(conn, key: str, known_version: int = -1):
+    """(state, data, version) ключа или None, если его версия всё ещё known_version"""
+    row = conn.execute('SELECT version FROM fsm_storage WHERE key = ?', (key,)).fetchone()
+    version = row[0] if row else 0
+    if version == known_version:
+        return None
+    if not row:
+        return None, '{}', 0
+    return (*conn.execute('SELECT state, data FROM fsm_storage WHERE key = ?', (key,)).fetchone(), version)
+
+
+@db.writer
+def save_fsm_state(conn, key: str, state: Optional[str]) -> int:
+    """Возвращает новую версию записи"""
+    return conn.execute('''INSERT INTO fsm_storage (key, state, updated_at) VALUES (?, ?, ?)
+                           ON CONFLICT (key) DO UPDATE SET state = excluded.state,
+                                                           updated_at = excluded.updated_at,
+                                                           version = version + 1
+                           RETURNING version''', (key, state, int(time.time()))).fetchone()[0]
+
+
+@db.writer
+def save_fsm_data(conn, key: str, data: str) -> int:
+    """Возвращает новую версию записи"""
+    return conn.execute('''INSERT INTO fsm_storage (key, data, updated_at) VALUES (?, ?, ?)
+                           ON CONFLICT (key) DO UPDATE SET data = excluded.data,
+                                                           updated_at = excluded.updated_at,
+                                                           version = version + 1
+                           RETURNING version''', (key, data, int(time.time()))).fetchone()[0]
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в SQLite с write-through LRU-кэшем в памяти.
+
+    Состояние переживает перезапуски и доступно нескольким процессам с общей
+    базой; в памяти держится не больше max_size записей, каждая живёт ttl
+    секунд. get_state вызывается на каждый апдейт, поэтому запись, проверенная
+    меньше revalidate секунд назад, отдаётся из кэша без обращения к базе -
+    изменение другим процессом становится видно не позже чем через revalidate
+    секунд. Дальше сверяется только версия записи, а заново читается и
+    разбирается лишь изменившаяся. Отсутствие записи кэшируется так же.
+    """
+
+    MISSING = (None, '{}', 0)  # записи нет: версия 0, как в load_fsm_record
+
+    def __init__(self, max_size: int = 10_000, ttl: float = 60.0, revalidate: float = 2.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.revalidate = revalidate
+        self._cache = OrderedDict()  # key -> [state, data (JSON), version, expires_at, checked_at]
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:" \
+               f"{key.business_connection_id or ''}:{key.destiny}"
+
+    def _remember(self, key: str, state: Optional[str], data: str, version: int):
+        now = time.monotonic()
+        self._cache[key] = [state, data, version, now + self.ttl, now]
+        self._cache.move_to_end(key)
+        while self._cache:
+            oldest = next(iter(self._cache.values()))
+            if len(self._cache) <= self.max_size and oldest[3] > now:
+                break
+            self._cache.popitem(last=False)
+
+    async def _record(self, key: str):
+        now = time.monotonic()
+        entry = self._cache.get(key)
+        if entry is None or entry[3] <= now:
+            known = -1
+        elif now - entry[4] < self.revalidate:
+            self._cache.move_to_end(key)
+            return entry
+        else:
+            known = entry[2]
+        row = await load_fsm_record(key, known)
+        if row is None:
+            entry[4] = time.monotonic()
+            if key in self._cache:  # пока шёл запрос, запись могли вытеснить
+                self._cache.move_to_end(key)
+            return entry
+        self._remember(key, *row)
+        return self._cache[key]
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        key = self._key(key)
+        version = await save_fsm_state(key, state)
+        # Версия на 1 больше известной - между нами запись никто не менял.
+        # Версия 1 - запись только что создана, её данные пусты
+        entry = self._cache.get(key) or self.MISSING
+        if version == entry[2] + 1:
+            self._remember(key, state, entry[1], version)
+        else:
+            self._cache.pop(key, None)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(self._key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        key = self._key(key)
+        data = json.dumps(dict(data), ensure_ascii=False)
+        version = await save_fsm_data(key, data)
+        entry = self._cache.get(key) or self.MISSING
+        if version == entry[2] + 1:
+            self._remember(key, entry[0], data, version)
+        else:
+            self._cache.pop(key, None)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return json.loads((await self._record(self._key(key)))[1])
+
+    async def close(self) -> None:
+        self._cache.clear()
+
+
+storage = SQLiteStorage()
+dp = Dispatcher(storage=storage)
+
+
+# ==================== РАССЫЛКА ====================
+
+BROADCAST_RATE = 30      # сообщений в секунду на весь бот (лимит Telegram)
+BROADCAST_PAGE = 200     # получателей за один шаг курсора
+BROADCAST_WORKERS = 16   # одновременных запросов к Telegram
+BROADCAST_RETRIES = 3
+
+
+class TokenBucket:
+    """Ведро токенов: в среднем rate событий в секунду, не больше capacity подряд"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def try_take(self, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self) -> float:
+        """Через сколько секунд появится следующий токен"""
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    async def take(self):
+        while not self.try_take():
+            await asyncio.sleep(self.delay())
+
+    def pause(self, seconds: float):
+        """Не выдавать токены seconds секунд (после RetryAfter)"""
+        self.tokens = -seconds * self.rate
+        self.updated = time.monotonic()
+
+
+@db.writer
+def create_broadcast(conn, admin_id: int, from_chat_id: int, message_id: int) -> int:
+    return conn.execute('''INSERT INTO broadcasts (admin_id, from_chat_id, message_id, created_at)
+                           VALUES (?, ?, ?, ?)''', (admin_id, from_chat_id, message_id, int(time.time()))).lastrowid
+
+
+@db.reader
+def load_active_broadcast(conn):
+    """(id, admin_id, from_chat_id, message_id, cursor, sent, failed, blocked) незавершённой рассылки или None"""
+    return conn.execute('''SELECT id, admin_id, from_chat_id, message_id, cursor, sent, failed, blocked
+                           FROM broadcasts WHERE status = 'running' ORDER BY id LIMIT 1''').fetchone()
+
+
+@db.reader
+def get_broadcast_recipients(conn, cursor: int, limit: int):
+    """Следующая страница получателей после cursor, без заблокировавших бота"""
+    return [user_id for user_id, in conn.execute(
+        '''SELECT user_id FROM users WHERE user_id > ?
+               AND NOT EXISTS (SELECT 1 FROM blocked_users b WHERE b.user_id = users.user_id)
+           ORDER BY user_id LIMIT ?''', (cursor, limit)
+    )]
+
+
+@db.writer
+def save_broadcast_progress(conn, broadcast_id: int, cursor: int, sent: int, failed: int, blocked_ids):
+    """Сдвигает курсор и счётчики рассылки вместе с записью заблокировавших бота"""
+    now = int(time.time())
+    conn.executemany('INSERT OR IGNORE INTO blocked_users (user_id, blocked_at) VALUES (?, ?)',
+                     [(user_id, now) for user_id in blocked_ids])
+    conn.execute('''UPDATE broadcasts SET cursor = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ?
+                    WHERE id = ?''', (cursor, sent, failed, len(blocked_ids), broadcast_id))
+
+
+@db.writer
+def set_broadcast_status(conn, broadcast_id: int, status: str):
+    conn.execute('UPDATE broadcasts SET status = ? WHERE id = ?', (status, broadcast_id))
+
+
+class Broadcaster:
+    """Рассылка сообщения админа всем игрокам.
+
+    Получатели читаются страницами по курсору users.user_id, поэтому память
+    не зависит от числа игроков. Отправка идёт через общее ведро токенов
+    (BROADCAST_RATE в секунду); RetryAfter останавливает ведро на указанное
+    время, а сообщение в этот чат повторяется не раньше, чем разрешил Telegram.
+    После каждой страницы курсор сохраняется: при перезапуске рассылка
+    продолжится с места остановки (не больше одной страницы повторов).
+    """
+
+    def __init__(self, rate: float = BROADCAST_RATE):
+        self.bucket = TokenBucket(rate, rate)
+        self.broadcast_id: Optional[int] = None
+        self.progress = [0, 0, 0]  # sent, failed, blocked
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self, admin_id: int, from_chat_id: int, message_id: int) -> Optional[int]:
+        if self.running:
+            return None
+        broadcast_id = await create_broadcast(admin_id, from_chat_id, message_id)
+        self._spawn((broadcast_id, admin_id, from_chat_id, message_id, 0, 0, 0, 0))
+        return broadcast_id
+
+    async def resume(self):
+        row = await load_active_broadcast()
+        if row:
+            logger.info(f"📢 Продолжаю рассылку #{row[0]} с user_id > {row[4]}")
+            self._spawn(row)
+
+    async def cancel(self) -> Optional[int]:
+        """Остановка админом: рассылка больше не продолжится"""
+        broadcast_id = self.broadcast_id
+        if not self.running:
+            return None
+        await self.stop()
+        await set_broadcast_status(broadcast_id, 'cancelled')
+        return broadcast_id
+
+    async def stop(self):
+        """Остановка бота: прогресс уже сохранён, рассылка продолжится после запуска"""
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    def _spawn(self, row):
+        self._task = asyncio.create_task(self._run(*row))
+
+    async def _send(self, chat_id: int, from_chat_id: int, message_id: int) -> str:
+        for _ in range(BROADCAST_RETRIES):
+            await self.bucket.take()
+            try:
+                await bot.copy_message(chat_id, from_chat_id, message_id)
+                return 'sent'
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except TelegramForbiddenError:
+                return 'blocked'
+            except TelegramBadRequest as e:
+                return 'blocked' if 'chat not found' in e.message.lower() else 'failed'
+            except TelegramNetworkError:
+                await asyncio.sleep(1)
+            except TelegramAPIError:
+                return 'failed'
+        return 'failed'
+
+    async def _run(self, broadcast_id, admin_id, from_chat_id, message_id, cursor, sent, failed, blocked):
+        self.broadcast_id = broadcast_id
+        self.progress = [sent, failed, blocked]
+        workers = asyncio.Semaphore(BROADCAST_WORKERS)
+
+        async def send(chat_id):
+            async with workers:
+                return await self._send(chat_id, from_chat_id, message_id)
+
+        while True:
+            recipients = await get_broadcast_recipients(cursor, BROADCAST_PAGE)
+            if not recipients:
+                break
+            results = await asyncio.gather(*(send(chat_id) for chat_id in recipients))
+            page_sent = results.count('sent')
+            page_failed = results.count('failed')
+            blocked_ids = [chat_id for chat_id, result in zip(recipients, results) if result == 'blocked']
+            cursor = recipients[-1]
+            await save_broadcast_progress(broadcast_id, cursor, page_sent, page_failed, blocked_ids)
+            self.progress[0] += page_sent
+            self.progress[1] += page_failed
+            self.progress[2] += len(blocked_ids)
+
+        await set_broadcast_status(broadcast_id, 'done')
+        sent, failed, blocked = self.progress
+        logger.info(f"📢 Рассылка #{broadcast_id} завершена: {sent} отправлено, {failed} ошибок, {blocked} заблокировали")
+        try:
+            await bot.send_message(
+                admin_id,
+                f"📢 <b>Рассылка #{broadcast_id} завершена</b>\n\n"
+                f"✅ Доставлено: {sent:,}\n"
+                f"❌ Ошибок: {failed:,}\n"
+                f"🚫 Заблокировали бота: {blocked:,}"
+            )
+        except TelegramAPIError:
+            pass
+
+
+broadcaster = Broadcaster()
+
+
+# ==================== АНТИФЛУД ====================
+
+FLOOD_RATE = 2.0   # обновлений в секунду от одного игрока в среднем
+FLOOD_BURST = 5    # и не больше стольких подряд
+
+
+class _FloodBucket:
+    __slots__ = ('tokens', 'updated', 'warned')
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+        self.warned = False
+
+
+class AntiFloodMiddleware(BaseMiddleware):
+    """Внешний middleware: у каждого игрока своё ведро токенов, лишние
+    обновления отбрасываются до хендлеров и не доходят до SQLite.
+
+    Из серии отброшенных нажатий кнопок на одно отвечаем "не так быстро",
+    остальные просто закрываем, сообщения отбрасываются молча. Ведро,
+    простоявшее rate / burst секунд, снова полное - такое же, как новое,
+    поэтому его можно выбросить: память держится только под активных игроков.
+    """
+
+    def __init__(self, rate: float = FLOOD_RATE, burst: int = FLOOD_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.idle = burst / rate
+        self._buckets = OrderedDict()  # user_id -> _FloodBucket, от давно молчавших к активным
+        self.passed = 0
+        self.shed = Counter()  # тип обновления -> отброшено
+
+    def _allow(self, user_id: int) -> Optional[_FloodBucket]:
+        """None, если обновление пропускается, иначе пустое ведро игрока"""
+        now = time.monotonic()
+        buckets = self._buckets
+        while buckets:
+            oldest = next(iter(buckets.values()))
+            if now - oldest.updated < self.idle:
+                break
+            buckets.popitem(last=False)
+        bucket = buckets.get(user_id)
+        if bucket is None:
+            buckets[user_id] = _FloodBucket(self.burst - 1, now)
+            return None
+        buckets.move_to_end(user_id)
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+        bucket.updated = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            bucket.warned = False
+            return None
+        return bucket
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user is None or user.id in ADMIN_IDS:
+            return await handler(event, data)
+        bucket = self._allow(user.id)
+        if bucket is None:
+            self.passed += 1
+            return await handler(event, data)
+        self.shed[type(event).__name__] += 1
+        if isinstance(event, types.CallbackQuery):
+            if bucket.warned:
+                return event.answer()
+            bucket.warned = True
+            return event.answer("⏳ Не так быстро!")
+        return None
+
+    @property
+    def tracked(self) -> int:
+        return len(self._buckets)
+
+
+antiflood = AntiFloodMiddleware()
+dp.message.outer_middleware(antiflood)
+dp.callback_query.outer_middleware(antiflood)
+
+
+# ==================== ВЫПАДЕНИЕ ТЕЛЕФОНОВ ====================
+
+class PhoneSampler:
+    """Розыгрыш редкости и модели за O(1), собирается один раз из каталога.
+
+    Редкость выбирается по alias-таблице Уолкера/Возе в целых числах: шансы
+    из RARITIES переводятся в точные целые веса, поэтому вероятности
+    совпадают с настроенными до последнего знака, включая 0.01% Легенды.
+    Модели хранятся кортежами PhoneModel и цен по редкостям.
+    """
+
+    def __init__(self, rarities, phones):
+        self.rarities = tuple(sorted(rarities))
+        chances = [Fraction(str(rarities[r]['chance'])) for r in self.rarities]
+        scale = 1
+        for chance in chances:
+            scale = scale * chance.denominator // math.gcd(scale, chance.denominator)
+        weights = [int(chance * scale) for chance in chances]
+        # Как и раньше, недостающие до 100% шансы достаются низшей редкости
+        weights[0] += max(0, 100 * scale - sum(weights))
+        self.total = sum(weights)
+        self._threshold, self._alias = self._build_alias(weights, self.total)
+        self._models = {r: tuple(phones.get(r, ())) for r in self.rarities}
+        self._prices = {r: tuple(model.price for model in self._models[r]) for r in self.rarities}
+        if np is not None:
+            self._np_rarities = np.array(self.rarities)
+            self._np_threshold = np.array(self._threshold, dtype=np.int64)
+            self._np_alias = np.array(self._alias)
+            self._np_counts = np.array([len(self._models[r]) for r in self.rarities])
+
+    @staticmethod
+    def _build_alias(weights, total):
+        """Alias-таблица Возе: колонка i выбирает себя, если u < threshold[i], иначе alias[i]"""
+        count = len(weights)
+        scaled = [w * count for w in weights]
+        threshold = [total] * count
+        alias = list(range(count))
+        small = [i for i, w in enumerate(scaled) if w < total]
+        large = [i for i, w in enumerate(scaled) if w >= total]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            threshold[less] = scaled[less]
+            alias[less] = more
+            scaled[more] -= total - scaled[less]
+            (small if scaled[more] < total else large).append(more)
+        return tuple(threshold), tuple(alias)
+
+    def draw_rarity(self) -> int:
+        column = random.randrange(len(self.rarities))
+        if random.randrange(self.total) >= self._threshold[column]:
+            column = self._alias[column]
+        return self.rarities[column]
+
+    def draw_model(self, rarity: int):
+        """PhoneModel редкости или None, если моделей нет"""
+        models = self._models.get(rarity)
+        if not models:
+            return None
+        return models[random.randrange(len(models))]
+
+    def draw_models(self, rarity: int, count: int):
+        """[PhoneModel, ...] - count моделей одной редкости"""
+        models = self._models.get(rarity)
+        if not models:
+            return []
+        if np is None:
+            indices = [random.randrange(len(models)) for _ in range(count)]
+        else:
+            indices = np.random.default_rng().integers(0, len(models), size=count).tolist()
+        return [models[index] for index in indices]
+
+    def draw(self):
+        """PhoneModel одной карточки"""
+        return self.draw_model(self.draw_rarity())
+
+    def draw_arrays(self, count: int, rng=None):
+        """(индексы редкостей, индексы моделей) для count карточек массивами numpy"""
+        rng = rng or np.random.default_rng()
+        columns = rng.integers(0, len(self.rarities), size=count)
+        hit = rng.integers(0, self.total, size=count) < self._np_threshold[columns]
+        columns = np.where(hit, columns, self._np_alias[columns])
+        models = rng.integers(0, np.maximum(self._np_counts[columns], 1))
+        return columns, models
+
+    def draw_many(self, count: int):
+        """[PhoneModel, ...] - count карточек одним векторным проходом"""
+        if np is None:
+            return [self.draw() for _ in range(count)]
+        columns, indices = self.draw_arrays(count)
+        cards = []
+        for column, index in zip(columns.tolist(), indices.tolist()):
+            models = self._models[self.rarities[column]]
+            cards.append(models[index] if models else None)
+        return cards
+
+
+# ==================== КАТАЛОГ ====================
+
+class CatalogError(ValueError):
+    pass
+
+
+class PhoneModel:
+    """Модель из каталога. id стабилен: его хранят user_phones и кнопки магазина,
+    поэтому при правке каталога id не меняют, а ненужные модели снимают с
+    продажи и выпадения флагом retired вместо удаления"""
+    __slots__ = ('id', 'name', 'rarity', 'price', 'retired')
+
+    def __init__(self, id, name, rarity, price, retired=False):
+        self.id = id
+        self.name = name
+        self.rarity = rarity
+        self.price = price
+        self.retired = retired
+
+
+class Catalog:
+    """Проверенный каталог: редкости, модели и сэмплер выпадения.
+
+    Таблицы только для чтения; перезагрузка строит новый каталог и подменяет
+    его целиком, так что хендлер никогда не видит наполовину обновлённые цены.
+    """
+    __slots__ = ('rarities', 'phones', 'models', 'sampler')
+
+    def __init__(self, rarities, models):
+        self.rarities = MappingProxyType({r: MappingProxyType(dict(info)) for r, info in rarities.items()})
+        # models - все модели по id, включая снятые; phones - доступные по редкостям
+        self.models = MappingProxyType({model.id: model for model in models})
+        self.phones = MappingProxyType({r: tuple(model for model in models if model.rarity == r and not model.retired)
+                                        for r in self.rarities})
+        self.sampler = PhoneSampler(self.rarities, self.phones)
+
+    @classmethod
+    def parse(cls, data):
+        """data - содержимое catalog.json:
+        {"rarities": [...], "phones": {"редкость": [{"id": 1, "name": "модель", "price": цена}, ...]}}"""
+        if not isinstance(data, dict) or not isinstance(data.get('rarities'), list) or not data['rarities']:
+            raise CatalogError("нужен непустой список rarities")
+        rarities = {}
+        for rarity, info in enumerate(data['rarities']):
+            if not isinstance(info, dict):
+                raise CatalogError(f"редкость {rarity}: ожидается объект")
+            for key in ('name', 'color'):
+                if not isinstance(info.get(key), str) or not info[key]:
+                    raise CatalogError(f"редкость {rarity}: нет {key}")
+            for key in ('chance', 'upgrade_chance'):
+                value = info.get(key)
+                if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value <= 100:
+                    raise CatalogError(f"редкость {rarity}: {key} должен быть числом от 0 до 100")
+            rarities[rarity] = {key: info[key] for key in ('name', 'color', 'chance', 'upgrade_chance')}
+        if sum(info['chance'] for info in rarities.values()) > 100:
+            raise CatalogError("сумма шансов выпадения больше 100%")
+        phones_data = data.get('phones')
+        if not isinstance(phones_data, dict):
+            raise CatalogError("нужен объект phones")
+        models = {}
+        for key, entries in phones_data.items():
+            if not key.isdigit() or int(key) not in rarities:
+                raise CatalogError(f"phones: неизвестная редкость {key!r}")
+            rarity = int(key)
+            if not isinstance(entries, list) or not entries:
+                raise CatalogError(f"phones[{rarity}]: нужен непустой список моделей")
+            names = set()
+            for entry in entries:
+                if not isinstance(entry, dict):
+                    raise CatalogError(f"phones[{rarity}]: модель должна быть объектом")
+                model_id, name, price = entry.get('id'), entry.get('name'), entry.get('price')
+                retired = entry.get('retired', False)
+                if isinstance(model_id, bool) or not isinstance(model_id, int) or model_id <= 0:
+                    raise CatalogError(f"phones[{rarity}]: id должен быть целым числом больше 0, а не {model_id!r}")
+                if model_id in models:
+                    raise CatalogError(f"phones[{rarity}]: id {model_id} уже занят")
+                if not isinstance(name, str) or not name.strip() or name in names:
+                    raise CatalogError(f"phones[{rarity}]: недопустимое или повторное имя {name!r}")
+                if isinstance(price, bool) or not isinstance(price, int) or price <= 0:
+                    raise CatalogError(f"phones[{rarity}][{name!r}]: цена должна быть целым числом больше 0")
+                if not isinstance(retired, bool):
+                    raise CatalogError(f"phones[{rarity}][{name!r}]: retired должен быть true или false")
+                names.add(name)
+                models[model_id] = PhoneModel(model_id, name, rarity, price, retired)
+        missing = [rarity for rarity in rarities
+                   if not any(model.rarity == rarity and not model.retired for model in models.values())]
+        if missing:
+            raise CatalogError(f"нет моделей для редкостей {missing}")
+        return cls(rarities, models.values())
+
+    def check_replaces(self, old: 'Catalog'):
+        """Каталог может заменить old, только если все его id остались на своих редкостях:
+        иначе телефоны игроков потеряют модель"""
+        for model in old.models.values():
+            new = self.models.get(model.id)
+            if new is None:
+                raise CatalogError(f"модель {model.id} ({model.name}) удалена - снимите её флагом retired")
+            if new.rarity != model.rarity:
+                raise CatalogError(f"модель {model.id} ({model.name}) перенесена в другую редкость")
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, encoding='utf-8') as f:
+            try:
+                data = json.load(f)
+            except json.JSONDecodeError as e:
+                raise CatalogError(f"{path}: {e}") from None
+        return cls.parse(data)
+
+
+def install_catalog(new: Catalog):
+    global catalog, RARITIES, PHONES_DB, MODELS, sampler
+    catalog, RARITIES, PHONES_DB, MODELS, sampler = new, new.rarities, new.phones, new.models, new.sampler
+
+
+install_catalog(Catalog.load(CATALOG_PATH))
+
+
+def reload_catalog() -> Catalog:
+    """Перечитывает каталог и пересобирает зависящие от него кэши. При ошибке
+    в файле бросает CatalogError/OSError, а бот продолжает работать со старым"""
+    new = Catalog.load(CATALOG_PATH)
+    new.check_replaces(catalog)
+    install_catalog(new)
+    reset_keyboards()
+    build_keyboards()
+    logger.info(f"📦 Каталог перезагружен: {sum(len(models) for models in new.phones.values())} моделей")
+    return new
+
+
+async def watch_catalog(interval: float = 2.0):
+    """Перезагрузка каталога при изменении файла: через watchfiles, если он
+    установлен, иначе опросом mtime раз в interval секунд"""
+    path = os.path.abspath(CATALOG_PATH)
+
+    def try_reload():
+        try:
+            reload_catalog()
+        except (CatalogError, OSError) as e:
+            logger.error(f"📦 Каталог не перезагружен, работаю со старым: {e}")
+
+    try:
+        import watchfiles
+    except ImportError:
+        watchfiles = None
+    if watchfiles is not None:
+        # Следим за папкой: редакторы сохраняют файл через переименование
+        async for _ in watchfiles.awatch(os.path.dirname(path),
+                                         watch_filter=lambda change, changed: os.path.abspath(changed) == path):
+            try_reload()
+        return
+    last_mtime = os.path.getmtime(path)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            continue
+        if mtime != last_mtime:
+            last_mtime = mtime
+            try_reload()
+
+
+def get_random_phone(rarity: int) -> Optional[PhoneModel]:
+    return sampler.draw_model(rarity)
+
+
+def model_name(model_id: int) -> str:
+    model = MODELS.get(model_id)
+    return model.name if model else f"#{model_id}"
 
 
 def calculate_rarity():
-    rand = random.uniform(0, 100)
-    cumulative = 0
-    for rarity in sorted(RARITIES.keys()):
-        cumulative += RARITIES[rarity]['chance']
-        if rand <= cumulative:
-            return rarity
-    return 0
+    return sampler.draw_rarity()
+
+
+def roll_upgrade(rarity: int) -> bool:
+    return random.uniform(0, 100) < RARITIES[rarity]['upgrade_chance']
+
+
+def roll_upgrades(chance: float, count: int):
+    """count проверок roll_upgrade одним проходом, с теми же шансами: 100 * U[0, 1) < upgrade_chance"""
+    if np is None:
+        return [random.uniform(0, 100) < chance for _ in range(count)]
+    return (np.random.default_rng().random(count) * 100 < chance).tolist()
+
+
+# ==================== КЛАВИАТУРЫ ====================
+
+KEYBOARD_CACHES = []
+
+
+def cached_keyboard(fn):
+    """Клавиатура зависит только от аргументов и каталога: строится один раз
+    и дальше отдаётся общий экземпляр. Возвращённую разметку не изменять."""
+    cached = functools.lru_cache(maxsize=None)(fn)
+    KEYBOARD_CACHES.append(cached)
+    return cached
+
+
+def reset_keyboards():
+    for cached in KEYBOARD_CACHES:
+        cached.cache_clear()
 
 
+def build_keyboards():
+    """Прогрев кэша: все статические клавиатуры и страницы магазина"""
+    for keyboard in (welcome_keyboard, main_keyboard, shop_keyboard, rarity_select_keyboard, sellall_keyboard,
+                     upgrade_keyboard, mass_upgrade_keyboard, help_keyboard, back_to_help_keyboard, upgrades_shop_keyboard, avito_keyboard,
+                     donate_keyboard, roulette_keyboard, tconfig_keyboard):
+        keyboard()
+    for rarity in PHONES_DB:
+        for page in range(shop_pages(rarity)):
+            shop_phones_keyboard(rarity, page)
+
+
+@cached_keyboard
 def main_keyboard():
     keyboard = [
         [KeyboardButton(text="🎴 ТКарточка"), KeyboardButton(text="👤 ТАкк")],
@@ -228,9 +1880,10 @@ def main_keyboard():
     return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
 
 
+@cached_keyboard
 def shop_keyboard():
     buttons = []
-    for r in range(6):
+    for r in range(len(RARITIES) - 2):
         buttons.append([InlineKeyboardButton(
             text=f"{RARITIES[r]['name']}",
             callback_data=f"shop_{r}"
@@ -239,32 +1892,33 @@ def shop_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def phones_list_keyboard(user_id: int, rarity: int, page: int = 0):
-    phones = get_user_phones(user_id, rarity)
+def phones_list_keyboard(rarity: int, page):
+    """page - результат get_phones_page: (телефоны, есть ли предыдущая, есть ли следующая)"""
+    phones, has_prev, has_next = page
     buttons = []
-    items_per_page = 5
-    start = page * items_per_page
-    end = start + items_per_page
-    for phone in phones[start:end]:
-        phone_id, _, phone_name, r, price, _ = phone
+    for phone in phones:
         buttons.append([InlineKeyboardButton(
-            text=f"{phone_name} ({price:,})",
-            callback_data=f"phone_{phone_id}"
+            text=f"{phone.phone_name} ({phone.price:,})",
+            callback_data=f"phone_{phone.id}"
         )])
     nav_buttons = []
-    if page > 0:
-        nav_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"myphones_{rarity}_{page-1}"))
-    if end < len(phones):
-        nav_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"myphones_{rarity}_{page+1}"))
+    # Курсор страницы - (price, id) крайнего телефона: p - до него, n - после него
+    if has_prev:
+        first = phones[0]
+        nav_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"myphones_{rarity}_p{first.price}_{first.id}"))
+    if has_next:
+        last = phones[-1]
+        nav_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"myphones_{rarity}_n{last.price}_{last.id}"))
     if nav_buttons:
         buttons.append(nav_buttons)
     buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_myphones")])
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+@cached_keyboard
 def rarity_select_keyboard():
     buttons = []
-    for r in range(7):
+    for r in range(len(RARITIES) - 1):
         buttons.append([InlineKeyboardButton(
             text=RARITIES[r]['name'],
             callback_data=f"myrarity_{r}"
@@ -273,16 +1927,66 @@ def rarity_select_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+@cached_keyboard
+def upgrade_keyboard():
+    buttons = [[InlineKeyboardButton(text=RARITIES[r]['name'], callback_data=f"myrarity_{r}")]
+               for r in range(len(RARITIES) - 1)]
+    buttons.append([InlineKeyboardButton(text="⚡ Массовый апгрейд", callback_data="massupg_menu")])
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_main")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@cached_keyboard
+def mass_upgrade_keyboard():
+    buttons = []
+    for r in range(len(RARITIES) - 1):
+        buttons.append([
+            InlineKeyboardButton(text=f"{RARITIES[r]['color']} ×10", callback_data=f"massupg_{r}_10"),
+            InlineKeyboardButton(text=f"{RARITIES[r]['color']} ×100", callback_data=f"massupg_{r}_100"),
+            InlineKeyboardButton(text=f"{RARITIES[r]['color']} Все", callback_data=f"massupg_{r}_all"),
+        ])
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_main")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@cached_keyboard
+def sellall_keyboard():
+    buttons = [[InlineKeyboardButton(text=RARITIES[r]['name'], callback_data=f"sellall_{r}")]
+               for r in range(len(RARITIES) - 1)]
+    buttons.append([InlineKeyboardButton(text="💰 Все редкости", callback_data="sellall_all")])
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_main")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@cached_keyboard
+def sellall_confirm_keyboard(rarity: Optional[int]):
+    """rarity=None - все редкости"""
+    target = "all" if rarity is None else rarity
+    buttons = [
+        [InlineKeyboardButton(text="✅ Продать", callback_data=f"sellallok_{target}")],
+        [InlineKeyboardButton(text="❌ Отменить", callback_data="sellall_menu")]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+SHOP_PAGE_SIZE = 5
+
+
+def shop_pages(rarity: int) -> int:
+    return (len(PHONES_DB.get(rarity, ())) + SHOP_PAGE_SIZE - 1) // SHOP_PAGE_SIZE
+
+
+@cached_keyboard
 def shop_phones_keyboard(rarity: int, page: int = 0):
-    phones = list(PHONES_DB.get(rarity, {}).items())
+    """Кэш не ограничен: вызывать только для существующих rarity и page < shop_pages(rarity)"""
+    phones = PHONES_DB.get(rarity, ())
     buttons = []
-    items_per_page = 5
-    start = page * items_per_page
-    end = start + items_per_page
-    for phone_name, price in phones[start:end]:
+    start = page * SHOP_PAGE_SIZE
+    end = start + SHOP_PAGE_SIZE
+    for model in phones[start:end]:
         buttons.append([InlineKeyboardButton(
-            text=f"{phone_name} - {price:,} ТОчек",
-            callback_data=f"buy_{rarity}_{phone_name}"
+            text=f"{model.name} - {model.price:,} ТОчек",
+            callback_data=f"buy_{model.id}"
         )])
     nav_buttons = []
     if page > 0:
@@ -295,14 +1999,100 @@ def shop_phones_keyboard(rarity: int, page: int = 0):
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-def buy_confirm_keyboard(rarity: int, phone_name: str):
+@cached_keyboard
+def buy_confirm_keyboard(rarity: int, model_id: int):
     buttons = [
-        [InlineKeyboardButton(text="✅ Купить", callback_data=f"confirm_buy_{rarity}_{phone_name}")],
+        [InlineKeyboardButton(text="✅ Купить", callback_data=f"confirm_buy_{model_id}")],
         [InlineKeyboardButton(text="❌ Отменить", callback_data=f"shop_{rarity}")]
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+@cached_keyboard
+def welcome_keyboard():
+    # Ссылка строится по профилю бота, поэтому клавиатура доступна только после bootstrap()
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Помощь 📚", callback_data="help_menu")],
+        [InlineKeyboardButton(text="➕ Добавить бота в чат", url=f"https://t.me/{bot_profile.username}?startgroup=true")]
+    ])
+
+
+@cached_keyboard
+def help_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔙 Вернуться назад", callback_data="back_start")],
+        [InlineKeyboardButton(text="📋 Команды", callback_data="commands_list")]
+    ])
+
+
+@cached_keyboard
+def back_to_help_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="help_menu")]
+    ])
+
+
+@cached_keyboard
+def upgrades_shop_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⏱ Уменьшить кулдаун карточки", callback_data="upgshop_card_cooldown")],
+        [InlineKeyboardButton(text="💰 Увеличить награду", callback_data="upgshop_daily_reward")],
+        [InlineKeyboardButton(text="⛏️ Улучшить майнинг ферму", callback_data="upgshop_farm")],
+        [InlineKeyboardButton(text="🎯 Увеличить шанс апгрейда", callback_data="upgshop_chance")],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_main")]
+    ])
+
+
+@cached_keyboard
+def avito_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📱 Все объявления", callback_data="avito_all")],
+        [InlineKeyboardButton(text="➕ Разместить объявление", callback_data="avito_create")],
+        [InlineKeyboardButton(text="📋 Мои объявления", callback_data="avito_my")],
+        [InlineKeyboardButton(text="🔍 Поиск по игроку", callback_data="avito_search")]
+    ])
+
+
+@cached_keyboard
+def donate_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⭐ VIP статус - 100₽", callback_data="donate_vip")],
+        [InlineKeyboardButton(text="💎 Premium статус - 300₽", callback_data="donate_premium")],
+        [InlineKeyboardButton(text="👑 Legendary статус - 500₽", callback_data="donate_legendary")],
+        [InlineKeyboardButton(text="💰 Пакет ТОчек - от 50₽", callback_data="donate_points")],
+        [InlineKeyboardButton(text="🎴 Эксклюзивный телефон - 200₽", callback_data="donate_phone")]
+    ])
+
+
+@cached_keyboard
+def roulette_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🎰 Крутить (10 ТОчек)", callback_data="spin_roulette_10")],
+        [InlineKeyboardButton(text="🎰 Крутить (100 ТОчек)", callback_data="spin_roulette_100")],
+        [InlineKeyboardButton(text="🎰 Крутить (1000 ТОчек)", callback_data="spin_roulette_1000")],
+        [InlineKeyboardButton(text="💎 Крутить за T-Coins", callback_data="spin_roulette_coins")]
+    ])
+
+
+@cached_keyboard
+def tconfig_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔔 Уведомления", callback_data="config_notifications")],
+        [InlineKeyboardButton(text="🎨 Тема оформления", callback_data="config_theme")],
+        [InlineKeyboardButton(text="🌐 Язык", callback_data="config_language")],
+        [InlineKeyboardButton(text="🔒 Приватность", callback_data="config_privacy")],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_main")]
+    ])
+
+
+@cached_keyboard
+def upgshop_confirm_keyboard(upgrade_type: str):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Купить", callback_data=f"confirm_upgshop_{upgrade_type}")],
+        [InlineKeyboardButton(text="❌ Отменить", callback_data="back_upgrades")]
+    ])
+
+
 # ==================== ХЕНДЛЕРЫ ====================
 
 @dp.message(Command("start"))
@@ -310,67 +2100,28 @@ async def cmd_start(message: types.Message):
     user_id = message.from_user.id
     username = message.from_user.username or ""
     first_name = message.from_user.first_name or ""
-    create_user(user_id, username, first_name)
-
-    commands = [
-        types.BotCommand(command="start", description="Приветственное сообщение"),
-        types.BotCommand(command="tcard", description="Получить карточку"),
-        types.BotCommand(command="tacc", description="Профиль и статистика"),
-        types.BotCommand(command="myphones", description="Мои телефоны"),
-        types.BotCommand(command="shop", description="Магазин телефонов"),
-        types.BotCommand(command="upgradeshop", description="Магазин улучшений"),
-        types.BotCommand(command="upgrade", description="Апгрейд телефона"),
-        types.BotCommand(command="daily", description="Ежедневная награда"),
-        types.BotCommand(command="top", description="Таблица лидеров"),
-        types.BotCommand(command="pay", description="Передать ТОчки"),
-        types.BotCommand(command="paycoin", description="Передать T-Coins"),
-        types.BotCommand(command="event", description="Текущий розыгрыш"),
-        types.BotCommand(command="sellall", description="Продать все телефоны"),
-        types.BotCommand(command="trade", description="Начать обмен"),
-        types.BotCommand(command="avito", description="Вторичный рынок"),
-        types.BotCommand(command="tfarm", description="Майнинг ферма"),
-        types.BotCommand(command="achievements", description="Достижения"),
-        types.BotCommand(command="donate", description="Каталог доната"),
-        types.BotCommand(command="roulette", description="Рулетка"),
-        types.BotCommand(command="tconfig", description="Настройки"),
-        types.BotCommand(command="tinfo", description="Информация"),
-        types.BotCommand(command="ping", description="Проверка связи"),
-    ]
-    await bot.set_my_commands(commands)
-
-    bot_info = await bot.get_me()
+    await create_user(user_id, username, first_name)
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Помощь 📚", callback_data="help_menu")],
-        [InlineKeyboardButton(text="➕ Добавить бота в чат", url=f"https://t.me/{bot_info.username}?startgroup=true")]
-    ])
-
-    await message.answer_photo(
-        photo="https://i.postimg.cc/HsVQVsZQ/photo_2026_03_01_03_52_06.jpg",
+    await media.send_photo(
+        bot, message.chat.id, 'welcome',
         caption=f"👋 Добро пожаловать, @{username}!\n\n"
                 f"🎴 Наш бот представляет из себя инструмент для "
                 f"коллекционирования различных моделей телефонов: от старого "
                 f"хлама до новых ультра флагманов.\n\n"
                 f"📱 Чтобы открыть вашу первую карточку напишите \"ТКарточка\".\n\n"
                 f"🎯 Используйте одну из кнопок ниже для взаимодействия с функциями:",
-        reply_markup=keyboard
+        reply_markup=welcome_keyboard()
     )
 
 
 @dp.callback_query(F.data == "help_menu")
 async def help_menu_callback(callback: types.CallbackQuery):
     """Меню помощи"""
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Вернуться назад", callback_data="back_start")],
-        [InlineKeyboardButton(text="📋 Команды", callback_data="commands_list")]
-    ])
-
     chat_id = callback.message.chat.id  # сохраняем ДО удаления
     await callback.message.delete()
 
-    await bot.send_photo(
-        chat_id=chat_id,
-        photo="https://i.postimg.cc/HsVQVsZQ/photo_2026_03_01_03_52_06.jpg",
+    await media.send_photo(
+        bot, chat_id, 'welcome',
         caption=f"ℹ️ <b>Наш бот представляет из себя инструмент для "
                 f"коллекционирования различных моделей телефонов: от старого "
                 f"хлама до новых ультра флагманов.</b>\n\n"
@@ -380,44 +2131,33 @@ async def help_menu_callback(callback: types.CallbackQuery):
                 f"🆘 <b>Нужна помощь или нашли ошибку?</b>\n"
                 f"Напишите: @hyper3os",
         parse_mode="HTML",
-        reply_markup=keyboard
+        reply_markup=help_keyboard()
     )
-    await callback.answer()
+    return callback.answer()
 
 
 @dp.callback_query(F.data == "back_start")
 async def back_start_callback(callback: types.CallbackQuery):
     """Возврат к приветствию"""
     username = callback.from_user.username or ""
-    bot_info = await bot.get_me()
-
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Помощь 📚", callback_data="help_menu")],
-        [InlineKeyboardButton(text="➕ Добавить бота в чат", url=f"https://t.me/{bot_info.username}?startgroup=true")]
-    ])
-
     chat_id = callback.message.chat.id  # сохраняем ДО удаления
     await callback.message.delete()
-    await bot.send_photo(
-        chat_id=chat_id,
-        photo="https://i.postimg.cc/HsVQVsZQ/photo_2026_03_01_03_52_06.jpg",
+    await media.send_photo(
+        bot, chat_id, 'welcome',
         caption=f"👋 Добро пожаловать, @{username}!\n\n"
                 f"🎴 Наш бот представляет из себя инструмент для "
                 f"коллекционирования различных моделей телефонов: от старого "
                 f"хлама до новых ультра флагманов.\n\n"
                 f"📱 Чтобы открыть вашу первую карточку напишите \"ТКарточка\".\n\n"
                 f"🎯 Используйте одну из кнопок ниже для взаимодействия с функциями:",
-        reply_markup=keyboard
+        reply_markup=welcome_keyboard()
     )
-    await callback.answer()
+    return callback.answer()
 
 
 @dp.callback_query(F.data == "commands_list")
 async def commands_list_callback(callback: types.CallbackQuery):
     """Список команд"""
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="help_menu")]
-    ])
     await callback.message.answer(
         text="<b>📱 СПИСОК КОМАНД:</b>\n\n"
              '• "ТКарточка" - карточка с телефоном (раз в 3 часа)\n'
@@ -441,24 +2181,15 @@ async def commands_list_callback(callback: types.CallbackQuery):
              '• /tinfo - информация сервера\n'
              '• /ping - пинг бота',
         parse_mode="HTML",
-        reply_markup=keyboard
+        reply_markup=back_to_help_keyboard()
     )
-    await callback.answer()
+    return callback.answer()
 
 
 @dp.callback_query(F.data == "about_bot")
 async def about_bot_callback(callback: types.CallbackQuery):
     """О боте"""
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="help_menu")]
-    ])
-    conn = sqlite3.connect('phones_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM users')
-    total_users = cursor.fetchone()[0]
-    cursor.execute('SELECT COUNT(*) FROM user_phones')
-    total_phones = cursor.fetchone()[0]
-    conn.close()
+    total_users, total_phones, _ = await get_bot_stats()
     await callback.message.edit_caption(
         caption=f"ℹ️ <b>Наш бот представляет из себя инструмент для "
                 f"коллекционирования различных моделей телефонов: от старого "
@@ -466,17 +2197,14 @@ async def about_bot_callback(callback: types.CallbackQuery):
                 f"📊 <b>Статистика:</b>\n"
                 f"👥 Пользователей: {total_users:,}\n"
                 f"📱 Телефонов выдано: {total_phones:,}",
-        reply_markup=keyboard
+        reply_markup=back_to_help_keyboard()
     )
-    await callback.answer()
+    return callback.answer()
 
 
 @dp.callback_query(F.data == "creators")
 async def creators_callback(callback: types.CallbackQuery):
     """Создатели"""
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="help_menu")]
-    ])
     await callback.message.edit_caption(
         caption="👥 <b>Создатели бота:</b>\n\n"
                 "• Владелец:\n"
@@ -486,13 +2214,69 @@ async def creators_callback(callback: types.CallbackQuery):
                 "🆘 <b>Нужна помощь, нашли ошибку или хотите предложить "
                 "идею? Напишите нашей оперативной поддержке:</b>\n"
                 "@hyper3os",
-        reply_markup=keyboard
+        reply_markup=back_to_help_keyboard()
     )
-    await callback.answer()
+    return callback.answer()
 
 
 # ==================== АЛИАСЫ КОМАНД ====================
 
+class AliasRouter:
+    """Текстовые команды ("тк", "ТАкк", "/pay ...") без цепочки фильтров F.text.in_:
+    алиасы без учёта регистра собираются в один dict, и сообщение находит свой
+    хендлер одним поиском. Текст длиннее самого длинного алиаса сразу отсекается,
+    если не начинается с команды, принимающей аргументы.
+    """
+
+    def __init__(self):
+        self._exact = {}   # алиас -> хендлер, текст целиком
+        self._prefix = {}  # алиас -> хендлер, первое слово (команды с аргументами)
+        self._max_len = 0
+
+    def register(self, *aliases: str, args: bool = False):
+        def decorator(handler):
+            for alias in aliases:
+                key = alias.casefold()
+                for table in (self._exact, self._prefix) if args else (self._exact,):
+                    if table.get(key, handler) is not handler:
+                        raise ValueError(f"Алиас {alias!r} уже занят хендлером {table[key].__name__}")
+                    table[key] = handler
+                self._max_len = max(self._max_len, len(key))
+            return handler
+        return decorator
+
+    def resolve(self, text: str, bot_username: Optional[str] = None):
+        words = text.split(maxsplit=1)
+        if not words:
+            return None
+        command = words[0]
+        if command.startswith('/') and '@' in command:
+            # "/pay@Bot ..." из меню команд в группе; команды другим ботам не наши
+            command, _, mention = command.partition('@')
+            if bot_username is not None and mention.casefold() != bot_username.casefold():
+                return None
+            text = f"{command} {words[1]}" if len(words) > 1 else command
+        if len(text) <= self._max_len:
+            handler = self._exact.get(text.casefold())
+            if handler is not None:
+                return handler
+        # С аргументами срабатывают только "/команда ..." и короткие алиасы перед @username:
+        # иначе "п привет" в чате вызывал бы /pay
+        if len(words) > 1 and (command.startswith('/') or words[1].startswith('@')):
+            return self._prefix.get(command.casefold())
+        return None
+
+    async def filter(self, message: types.Message):
+        """Фильтр aiogram: передаёт найденный хендлер в alias_handler"""
+        if not message.text:
+            return False
+        handler = self.resolve(message.text, bot_profile.username if bot_profile else None)
+        return {'alias_handler': handler} if handler else False
+
+
+aliases = AliasRouter()
+
+
 @dp.message(Command("tacc"))
 async def tacc_command(message: types.Message):
     await show_account(message)
@@ -531,54 +2315,42 @@ async def top_command(message: types.Message):
 # ==================== КАРТОЧКА ====================
 
 @dp.message(Command("tcard"))
-@dp.message(F.text.in_(["ТКарточка", "тк", "TC", "tc"]))
+@aliases.register("ТКарточка", "тк", "TC", "tc", "🎴 ТКарточка")
 async def get_card(message: types.Message):
     user_id = message.from_user.id
-    user = get_user(user_id)
+    now = int(time.time())
+    wait = card_cooldowns.remaining(user_id, now)
 
-    if not user:
-        await message.answer("❌ Используйте /start сначала!")
-        return
+    if not wait:
+        rarity = calculate_rarity()
+        model = get_random_phone(rarity)
 
-    last_card = user[8]
-    if last_card:
-        last_time = datetime.fromisoformat(last_card)
-        next_time = last_time + timedelta(hours=3)
-        now = datetime.now()
-        if now < next_time:
-            diff = next_time - now
-            hours = int(diff.total_seconds() // 3600)
-            minutes = int((diff.total_seconds() % 3600) // 60)
-            seconds = int(diff.total_seconds() % 60)
-            await message.answer(
-                f"⏰ Следующая карточка будет доступна через:\n"
-                f"{hours:02d}:{minutes:02d}:{seconds:02d}"
-            )
+        if not model:
+            await message.answer("❌ Ошибка! Попробуйте позже.")
             return
 
-    rarity = calculate_rarity()
-    phone_name, price = get_random_phone(rarity)
+        # Кулдаун проверяется и телефон выдаётся одной транзакцией
+        phone_id, ready_at = await grant_card(user_id, model, now)
+        if ready_at is None:
+            await message.answer("❌ Используйте /start сначала!")
+            return
+        card_cooldowns.set(user_id, ready_at)
+        if phone_id is None:
+            wait = ready_at - now
 
-    if not phone_name:
-        await message.answer("❌ Ошибка! Попробуйте позже.")
+    if wait:
+        await message.answer(
+            f"⏰ Следующая карточка будет доступна через:\n"
+            f"{wait // 3600:02d}:{wait % 3600 // 60:02d}:{wait % 60:02d}"
+        )
         return
 
-    # ИСПРАВЛЕНО: add_phone теперь возвращает phone_id
-    phone_id = add_phone(user_id, phone_name, rarity, price)
-
-    conn = sqlite3.connect('phones_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET last_card = ?, cards = cards + 1 WHERE user_id = ?',
-                   (datetime.now().isoformat(), user_id))
-    conn.commit()
-    conn.close()
-
     rarity_name = RARITIES[rarity]['name']
 
     await message.answer(
         f"@{message.from_user.username} Вам выпал телефон!\n\n"
-        f"{RARITIES[rarity]['color']} <b>{phone_name}</b>\n"
-        f"{rarity_name} | Цена: <b>{price:,} ТОчек</b>",
+        f"{RARITIES[rarity]['color']} <b>{model.name}</b>\n"
+        f"{rarity_name} | Цена: <b>{model.price:,} ТОчек</b>",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="⚙️ Действия", callback_data=f"phone_{phone_id}")]
         ])
@@ -587,21 +2359,22 @@ async def get_card(message: types.Message):
 
 # ==================== ПРОФИЛЬ ====================
 
-@dp.message(F.text.in_(["ТАкк", "та", "TA", "ta"]))
+@aliases.register("ТАкк", "та", "TA", "ta", "👤 ТАкк")
 async def show_account(message: types.Message):
     user_id = message.from_user.id
-    user = get_user(user_id)
+    user = await get_user(user_id)
     if not user:
         await message.answer("❌ Используйте /start сначала!")
         return
-    points = user[3]
-    cards = user[4]
-    total_phones = user[5]
-    phones = get_user_phones(user_id)
-    total_value = sum(phone[4] for phone in phones)
+    points = user.points
+    cards = user.cards
+    total_phones = user.total_phones
+    rank = ranking.rank(user_id)
+    collection = await get_collection(user_id)
+    total_value = sum(value for _, value in collection.values())
     await message.answer(
         f"<b>@{message.from_user.username}</b>\n"
-        f"<b>Место в топе:</b> #???\n"
+        f"<b>Место в топе:</b> #{rank or '???'}\n"
         f"<b>ТОчек:</b> {points:,}\n"
         f"<b>Карточек:</b> {cards}\n\n"
         f"👤 <b>Профиль:</b> @{message.from_user.username}\n"
@@ -615,11 +2388,10 @@ async def show_account(message: types.Message):
 
 # ==================== МОИ ТЕЛЕФОНЫ ====================
 
-@dp.message(F.text.in_(["Мои телефоны", "мо", "mp", "МО", "MP"]))
+@aliases.register("Мои телефоны", "мо", "mp", "МО", "MP", "📱 Мои телефоны")
 async def my_phones(message: types.Message):
     user_id = message.from_user.id
-    phones = get_user_phones(user_id)
-    if not phones:
+    if not await get_collection(user_id):
         await message.answer("📱 У вас пока нет телефонов! Используйте 🎴 ТКарточка")
         return
     await message.answer(
@@ -632,20 +2404,38 @@ async def my_phones(message: types.Message):
 async def show_rarity_phones(callback: types.CallbackQuery):
     rarity = int(callback.data.split("_")[1])
     user_id = callback.from_user.id
-    phones = get_user_phones(user_id, rarity)
-    if not phones:
-        await callback.answer(f"У вас нет телефонов редкости {RARITIES[rarity]['name']}", show_alert=True)
-        return
+    page = await get_phones_page(user_id, rarity)
+    if not page[0]:
+        return callback.answer(f"У вас нет телефонов редкости {RARITIES[rarity]['name']}", show_alert=True)
     await callback.message.edit_text(
         f"📱 <b>{RARITIES[rarity]['name']}</b>\n\nВаши телефоны:",
-        reply_markup=phones_list_keyboard(user_id, rarity, 0)
+        reply_markup=phones_list_keyboard(rarity, page)
     )
-    await callback.answer()
+    return callback.answer()
+
+
+@dp.callback_query(F.data.startswith("myphones_"))
+async def page_rarity_phones(callback: types.CallbackQuery):
+    """Листание телефонов: myphones_{rarity}_{n|p}{price}_{id}"""
+    _, rarity, *cursor = callback.data.split("_")
+    rarity = int(rarity)
+    user_id = callback.from_user.id
+    page = None
+    if len(cursor) == 2 and cursor[0][:1] in ("n", "p"):
+        page = await get_phones_page(user_id, rarity, (int(cursor[0][1:]), int(cursor[1])),
+                                     backward=cursor[0][0] == "p")
+    if not page or not page[0]:
+        # Старые кнопки с номером страницы или телефоны уже проданы - с начала
+        page = await get_phones_page(user_id, rarity)
+    if not page[0]:
+        return callback.answer(f"У вас нет телефонов редкости {RARITIES[rarity]['name']}", show_alert=True)
+    await callback.message.edit_reply_markup(reply_markup=phones_list_keyboard(rarity, page))
+    return callback.answer()
 
 
 # ==================== МАГАЗИН ====================
 
-@dp.message(F.text.in_(["Магазин телефонов", "мт", "ps", "МТ", "PS"]))
+@aliases.register("Магазин телефонов", "мт", "ps", "МТ", "PS", "🏪 Магазин телефонов")
 async def shop(message: types.Message):
     await message.answer(
         "🏪 <b>Магазин телефонов</b>\n\nВыберите редкость:",
@@ -653,23 +2443,15 @@ async def shop(message: types.Message):
     )
 
 
-@dp.message(F.text.in_(["Магазин улучшений", "му", "us", "МУ", "US"]))
+@aliases.register("Магазин улучшений", "му", "us", "МУ", "US")
 async def upgrades_shop(message: types.Message):
     user_id = message.from_user.id
-    user = get_user(user_id)
-    points = user[3] if user else 0
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⏱ Уменьшить кулдаун карточки", callback_data="upgshop_card_cooldown")],
-        [InlineKeyboardButton(text="💰 Увеличить награду", callback_data="upgshop_daily_reward")],
-        [InlineKeyboardButton(text="⛏️ Улучшить майнинг ферму", callback_data="upgshop_farm")],
-        [InlineKeyboardButton(text="🎯 Увеличить шанс апгрейда", callback_data="upgshop_chance")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_main")]
-    ])
+    points = await get_points(user_id)
     await message.answer(
         "🏪 <b>Магазин улучшений</b>\n\n"
         f"💰 Ваш баланс: {points:,} ТОчек\n\n"
         "Выберите улучшение:",
-        reply_markup=keyboard
+        reply_markup=upgrades_shop_keyboard()
     )
 
 
@@ -684,42 +2466,29 @@ async def process_upgrade_purchase(callback: types.CallbackQuery):
         "chance": {"name": "Увеличение шанса апгрейда", "price": 15000, "desc": "🎯 +5% к шансу успеха"}
     }
     if upgrade_type not in upgrades:
-        await callback.answer("❌ Неизвестное улучшение!")
-        return
+        return callback.answer("❌ Неизвестное улучшение!")
     upgrade = upgrades[upgrade_type]
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Купить", callback_data=f"confirm_upgshop_{upgrade_type}")],
-        [InlineKeyboardButton(text="❌ Отменить", callback_data="back_upgrades")]
-    ])
     await callback.message.edit_text(
         f"🏪 <b>{upgrade['name']}</b>\n\n"
         f"{upgrade['desc']}\n\n"
         f"💰 Цена: {upgrade['price']:,} ТОчек\n\n"
         f"⚠️ Функция в разработке!",
-        reply_markup=keyboard
+        reply_markup=upgshop_confirm_keyboard(upgrade_type)
     )
-    await callback.answer()
+    return callback.answer()
 
 
 @dp.callback_query(F.data == "back_upgrades")
 async def back_upgrades(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    user = get_user(user_id)
-    points = user[3] if user else 0
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⏱ Уменьшить кулдаун карточки", callback_data="upgshop_card_cooldown")],
-        [InlineKeyboardButton(text="💰 Увеличить награду", callback_data="upgshop_daily_reward")],
-        [InlineKeyboardButton(text="⛏️ Улучшить майнинг ферму", callback_data="upgshop_farm")],
-        [InlineKeyboardButton(text="🎯 Увеличить шанс апгрейда", callback_data="upgshop_chance")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_main")]
-    ])
+    points = await get_points(user_id)
     await callback.message.edit_text(
         "🏪 <b>Магазин улучшений</b>\n\n"
         f"💰 Ваш баланс: {points:,} ТОчек\n\n"
         "Выберите улучшение:",
-        reply_markup=keyboard
+        reply_markup=upgrades_shop_keyboard()
     )
-    await callback.answer()
+    return callback.answer()
 
 
 @dp.callback_query(F.data.startswith("shop_"))
@@ -727,73 +2496,117 @@ async def show_shop_rarity(callback: types.CallbackQuery):
     parts = callback.data.split("_")
     rarity = int(parts[1])
     page = int(parts[2]) if len(parts) > 2 else 0
+    # callback_data приходит от клиента: чужие номера не должны плодить записи кэша клавиатур
+    if rarity not in RARITIES or not 0 <= page < shop_pages(rarity):
+        return callback.answer()
     await callback.message.edit_text(
         f"🏪 <b>{RARITIES[rarity]['name']}</b>\n\nДоступные телефоны:",
         reply_markup=shop_phones_keyboard(rarity, page)
     )
-    await callback.answer()
+    return callback.answer()
+
+
+def model_on_sale(data: str, prefix: str) -> Optional['PhoneModel']:
+    """Модель из callback_data ровно вида {prefix}{id}, если она ещё продаётся.
+
+    Старые кнопки {prefix}{rarity}_{название} остались в чатах игроков: номер
+    редкости в них нельзя принимать за id модели, такие кнопки считаются снятыми.
+    """
+    model_id = data[len(prefix):]
+    if not (model_id.isascii() and model_id.isdigit()):
+        return None
+    model = MODELS.get(int(model_id))
+    return None if model is None or model.retired else model
 
 
 @dp.callback_query(F.data.startswith("buy_"))
 async def buy_phone_confirm(callback: types.CallbackQuery):
-    parts = callback.data.split("_", 2)
-    rarity = int(parts[1])
-    phone_name = parts[2]
-    price = PHONES_DB[rarity][phone_name]
+    model = model_on_sale(callback.data, "buy_")
+    if model is None:
+        return callback.answer("❌ Этот телефон больше не продаётся!", show_alert=True)
     user_id = callback.from_user.id
-    points = get_points(user_id)
+    points = await get_points(user_id)
     await callback.message.edit_text(
-        f"📱 <b>{phone_name}</b>\n\n"
-        f"{RARITIES[rarity]['name']}\n"
-        f"💰 Цена: {price:,} ТОчек\n"
+        f"📱 <b>{model.name}</b>\n\n"
+        f"{RARITIES[model.rarity]['name']}\n"
+        f"💰 Цена: {model.price:,} ТОчек\n"
         f"💵 Ваш баланс: {points:,} ТОчек\n\n"
         f"Подтвердите покупку:",
-        reply_markup=buy_confirm_keyboard(rarity, phone_name)
+        reply_markup=buy_confirm_keyboard(model.rarity, model.id)
     )
-    await callback.answer()
+    return callback.answer()
 
 
 @dp.callback_query(F.data.startswith("confirm_buy_"))
 async def confirm_buy(callback: types.CallbackQuery):
-    parts = callback.data.split("_", 3)
-    rarity = int(parts[2])
-    phone_name = parts[3]
-    price = PHONES_DB[rarity][phone_name]
+    model = model_on_sale(callback.data, "confirm_buy_")
+    if model is None:
+        return callback.answer("❌ Этот телефон больше не продаётся!", show_alert=True)
     user_id = callback.from_user.id
-    points = get_points(user_id)
-    if points < price:
-        await callback.answer(f"❌ Недостаточно ТОчек! Нужно: {price:,}", show_alert=True)
-        return
-    update_points(user_id, -price)
-    add_phone(user_id, phone_name, rarity, price)
+    bought = await buy_phone(user_id, model)
+    if not bought:
+        return callback.answer(f"❌ Недостаточно ТОчек! Нужно: {model.price:,}", show_alert=True)
+    _, balance = bought
     await callback.message.edit_text(
         f"✅ <b>Покупка успешна!</b>\n\n"
-        f"📱 {phone_name}\n"
-        f"💰 Потрачено: {price:,} ТОчек\n"
-        f"💵 Остаток: {get_points(user_id):,} ТОчек"
+        f"📱 {model.name}\n"
+        f"💰 Потрачено: {model.price:,} ТОчек\n"
+        f"💵 Остаток: {balance:,} ТОчек"
     )
-    await callback.answer()
+    return callback.answer()
 
 
 # ==================== АПГРЕЙД ====================
 
-@dp.message(F.text.in_(["Апгрейд", "ап", "up", "АП", "UP"]))
+@aliases.register("Апгрейд", "ап", "up", "АП", "UP", "⬆️ Апгрейд")
 async def upgrade_menu(message: types.Message):
+    chances = "\n".join(
+        f"{RARITIES[r]['name']} → {RARITIES[r + 1]['name']}: {RARITIES[r]['upgrade_chance']:g}%"
+        for r in range(len(RARITIES) - 1)
+    )
     await message.answer(
         "⬆️ <b>Апгрейд телефона</b>\n\n"
         "Выберите редкость телефона который хотите улучшить:\n\n"
-        "ℹ️ Шансы улучшения:\n"
-        "📱 Шифротребность → Необычный: 50%\n"
-        "📱 Необычный → Редкий: 40%\n"
-        "⭐ Редкий → Мистический: 30%\n"
-        "✨ Мистический → Хроматический: 20%\n"
-        "💎 Хроматический → Аркана: 10%\n"
-        "🏆 Аркана → Раритет: 5%\n"
-        "🎨 Раритет → Легенда: 2%",
-        reply_markup=rarity_select_keyboard()
+        f"ℹ️ Шансы улучшения:\n{chances}",
+        reply_markup=upgrade_keyboard()
     )
 
 
+@dp.callback_query(F.data == "massupg_menu")
+async def mass_upgrade_menu(callback: types.CallbackQuery):
+    await callback.message.edit_text(
+        "⚡ <b>Массовый апгрейд</b>\n\n"
+        "Улучшает сразу 10, 100 или все телефоны выбранной редкости,\n"
+        "начиная с самых дешёвых. Шансы те же, что и у обычного апгрейда.\n\n"
+        "⚠️ Неудачно улучшенные телефоны теряются!",
+        reply_markup=mass_upgrade_keyboard()
+    )
+    return callback.answer()
+
+
+@dp.callback_query(F.data.startswith("massupg_"))
+async def mass_upgrade(callback: types.CallbackQuery):
+    _, rarity, count = callback.data.split("_")
+    rarity = int(rarity)
+    if rarity >= len(RARITIES) - 1:
+        return callback.answer("❌ Это максимальная редкость!", show_alert=True)
+    limit = None if count == "all" else int(count)
+    attempts, upgraded, spent, gained = await upgrade_phones(callback.from_user.id, rarity, limit)
+    if not attempts:
+        return callback.answer("❌ Нет телефонов этой редкости!", show_alert=True)
+    await callback.message.edit_text(
+        f"⚡ <b>Массовый апгрейд завершён!</b>\n\n"
+        f"{RARITIES[rarity]['name']} → {RARITIES[rarity + 1]['name']}\n"
+        f"🎲 Попыток: {attempts:,}\n"
+        f"🎉 Улучшено: {upgraded:,}\n"
+        f"😔 Потеряно: {attempts - upgraded:,}\n\n"
+        f"💔 Вложено телефонов на: {spent:,} ТОчек\n"
+        f"✨ Получено телефонов на: {gained:,} ТОчек\n"
+        f"📊 Итог: {gained - spent:+,} ТОчек"
+    )
+    return callback.answer()
+
+
 # ИСПРАВЛЕНО: переименован с upgrade_ на do_upgrade_ чтобы не конфликтовать с магазином улучшений
 @dp.callback_query(F.data.startswith("do_upgrade_"))
 async def perform_upgrade(callback: types.CallbackQuery):
@@ -801,47 +2614,32 @@ async def perform_upgrade(callback: types.CallbackQuery):
     phone_id = int(parts[2])
     user_id = callback.from_user.id
 
-    conn = sqlite3.connect('phones_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM user_phones WHERE id = ? AND user_id = ?', (phone_id, user_id))
-    phone = cursor.fetchone()
+    phone = await get_user_phone(phone_id, user_id)
 
     if not phone:
-        await callback.answer("❌ Телефон не найден!", show_alert=True)
-        conn.close()
-        return
-
-    phone_id, _, phone_name, rarity, price, _ = phone
+        return callback.answer("❌ Телефон не найден!", show_alert=True)
 
-    if rarity >= 7:
-        await callback.answer("❌ Это максимальная редкость!", show_alert=True)
-        conn.close()
-        return
+    phone_name, rarity, price = phone.phone_name, phone.rarity, phone.price
 
-    upgrade_chance = RARITIES[rarity]['upgrade_chance']
-    success = random.uniform(0, 100) < upgrade_chance
+    if rarity >= len(RARITIES) - 1:
+        return callback.answer("❌ Это максимальная редкость!", show_alert=True)
 
-    if success:
+    if roll_upgrade(rarity):
         new_rarity = rarity + 1
-        new_phone, new_price = get_random_phone(new_rarity)
-        cursor.execute('DELETE FROM user_phones WHERE id = ?', (phone_id,))
-        cursor.execute('''INSERT INTO user_phones (user_id, phone_name, rarity, price)
-                          VALUES (?, ?, ?, ?)''', (user_id, new_phone, new_rarity, new_price))
-        conn.commit()
-        conn.close()
+        new_phone = get_random_phone(new_rarity)
+        if not await replace_phone(phone_id, user_id, new_phone):
+            return callback.answer("❌ Телефон не найден!", show_alert=True)
         await callback.message.edit_text(
             f"🎉 <b>УСПЕХ!</b>\n\n"
             f"Ваш телефон:\n"
             f"{RARITIES[rarity]['color']} {phone_name} ({price:,} ТОчек)\n\n"
             f"Улучшен до:\n"
-            f"{RARITIES[new_rarity]['color']} {new_phone} ({new_price:,} ТОчек)\n\n"
-            f"✨ Прибыль: +{new_price - price:,} ТОчек"
+            f"{RARITIES[new_rarity]['color']} {new_phone.name} ({new_phone.price:,} ТОчек)\n\n"
+            f"✨ Прибыль: +{new_phone.price - price:,} ТОчек"
         )
     else:
-        cursor.execute('DELETE FROM user_phones WHERE id = ?', (phone_id,))
-        cursor.execute('UPDATE users SET total_phones = total_phones - 1 WHERE user_id = ?', (user_id,))
-        conn.commit()
-        conn.close()
+        if not await destroy_phone(phone_id, user_id):
+            return callback.answer("❌ Телефон не найден!", show_alert=True)
         await callback.message.edit_text(
             f"😔 <b>НЕУДАЧА!</b>\n\n"
             f"Ваш телефон:\n"
@@ -849,7 +2647,7 @@ async def perform_upgrade(callback: types.CallbackQuery):
             f"❌ Был утерян при улучшении...\n"
             f"💔 Потеря: -{price:,} ТОчек"
         )
-    await callback.answer()
+    return callback.answer()
 
 
 @dp.callback_query(F.data.startswith("phone_"))
@@ -857,17 +2655,12 @@ async def show_phone_actions(callback: types.CallbackQuery):
     phone_id = int(callback.data.split("_")[1])
     user_id = callback.from_user.id
 
-    conn = sqlite3.connect('phones_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM user_phones WHERE id = ? AND user_id = ?', (phone_id, user_id))
-    phone = cursor.fetchone()
-    conn.close()
+    phone = await get_user_phone(phone_id, user_id)
 
     if not phone:
-        await callback.answer("❌ Телефон не найден!", show_alert=True)
-        return
+        return callback.answer("❌ Телефон не найден!", show_alert=True)
 
-    _, _, phone_name, rarity, price, obtained_at = phone
+    phone_name, rarity, price = phone.phone_name, phone.rarity, phone.price
     sell_price = int(price * 0.75)
 
     buttons = [
@@ -886,7 +2679,7 @@ async def show_phone_actions(callback: types.CallbackQuery):
         f"Выберите действие:",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons)
     )
-    await callback.answer()
+    return callback.answer()
 
 
 @dp.callback_query(F.data.startswith("sell_"))
@@ -894,83 +2687,55 @@ async def sell_phone(callback: types.CallbackQuery):
     phone_id = int(callback.data.split("_")[1])
     user_id = callback.from_user.id
 
-    conn = sqlite3.connect('phones_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM user_phones WHERE id = ? AND user_id = ?', (phone_id, user_id))
-    phone = cursor.fetchone()
+    sold = await sell_user_phone(phone_id, user_id)
 
-    if not phone:
-        await callback.answer("❌ Телефон не найден!", show_alert=True)
-        conn.close()
-        return
-
-    _, _, phone_name, rarity, price, _ = phone
-    sell_price = int(price * 0.75)
+    if not sold:
+        return callback.answer("❌ Телефон не найден!", show_alert=True)
 
-    cursor.execute('DELETE FROM user_phones WHERE id = ?', (phone_id,))
-    cursor.execute('UPDATE users SET points = points + ?, total_phones = total_phones - 1 WHERE user_id = ?',
-                   (sell_price, user_id))
-    conn.commit()
-    conn.close()
+    phone_name, rarity, sell_price, balance = sold
 
     await callback.message.edit_text(
         f"💰 <b>Продано!</b>\n\n"
         f"📱 {phone_name}\n"
         f"{RARITIES[rarity]['name']}\n\n"
         f"💸 Получено: {sell_price:,} ТОчек\n"
-        f"💵 Ваш баланс: {get_points(user_id):,} ТОчек"
+        f"💵 Ваш баланс: {balance:,} ТОчек"
     )
-    await callback.answer()
+    return callback.answer()
 
 
 # ==================== ПРОЧИЕ КОМАНДЫ ====================
 
-@dp.message(F.text.in_(["Ежедневная награда", "ен", "er", "ЕН", "ER"]))
+@aliases.register("Ежедневная награда", "ен", "er", "ЕН", "ER", "🎁 Ежедневная награда")
 async def daily_reward(message: types.Message):
     user_id = message.from_user.id
-    user = get_user(user_id)
-    if not user:
-        await message.answer("❌ Используйте /start сначала!")
-        return
-    last_daily = user[9]
-    if last_daily:
-        last_time = datetime.fromisoformat(last_daily)
-        next_time = last_time + timedelta(hours=24)
-        now = datetime.now()
-        if now < next_time:
-            diff = next_time - now
-            hours = int(diff.total_seconds() // 3600)
-            minutes = int((diff.total_seconds() % 3600) // 60)
-            await message.answer(
-                f"⏰ Следующая награда будет доступна через:\n"
-                f"{hours:02d}:{minutes:02d}:00"
-            )
-            return
+    now = int(time.time())
     reward = 100
-    update_points(user_id, reward)
-    conn = sqlite3.connect('phones_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET last_daily = ? WHERE user_id = ?',
-                   (datetime.now().isoformat(), user_id))
-    conn.commit()
-    conn.close()
+    wait = daily_cooldowns.remaining(user_id, now)
+    if not wait:
+        balance, ready_at = await claim_daily(user_id, reward, now)
+        if ready_at is None:
+            await message.answer("❌ Используйте /start сначала!")
+            return
+        daily_cooldowns.set(user_id, ready_at)
+        if balance is None:
+            wait = ready_at - now
+    if wait:
+        await message.answer(
+            f"⏰ Следующая награда будет доступна через:\n"
+            f"{wait // 3600:02d}:{wait % 3600 // 60:02d}:00"
+        )
+        return
     await message.answer(
         f"🎁 <b>Ежедневная награда!</b>\n\n"
         f"Вы получили: <b>{reward} ТОчек</b>\n"
-        f"💰 Баланс: {get_points(user_id):,} ТОчек"
+        f"💰 Баланс: {balance:,} ТОчек"
     )
 
 
-@dp.message(F.text.in_(["Таблица лидеров", "тл", "lb", "ТЛ", "LB"]))
+@aliases.register("Таблица лидеров", "тл", "lb", "ТЛ", "LB", "🏆 Таблица лидеров")
 async def leaderboard(message: types.Message):
-    conn = sqlite3.connect('phones_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT user_id, first_name, username, points, total_phones
-        FROM users ORDER BY points DESC LIMIT 10
-    ''')
-    leaders = cursor.fetchall()
-    conn.close()
+    leaders = ranking.top(10)
     if not leaders:
         await message.answer("🏆 Таблица лидеров пуста!")
         return
@@ -984,17 +2749,67 @@ async def leaderboard(message: types.Message):
     await message.answer(text)
 
 
-@dp.message(F.text.in_(["/sellall", "са", "sa", "СА", "SA"]))
+SELLALL_MENU_TEXT = (
+    "💰 <b>Продать все телефоны</b>\n\n"
+    "Выберите редкость телефонов для продажи:\n"
+    "⚠️ Вы получите 75% от стоимости"
+)
+
+
+@aliases.register("/sellall", "са", "sa", "СА", "SA")
 async def sellall_menu(message: types.Message):
-    await message.answer(
-        "💰 <b>Продать все телефоны</b>\n\n"
-        "Выберите редкость телефонов для продажи:\n"
-        "⚠️ Вы получите 75% от стоимости",
-        reply_markup=rarity_select_keyboard()
+    await message.answer(SELLALL_MENU_TEXT, reply_markup=sellall_keyboard())
+
+
+@dp.callback_query(F.data == "sellall_menu")
+async def back_sellall(callback: types.CallbackQuery):
+    await callback.message.edit_text(SELLALL_MENU_TEXT, reply_markup=sellall_keyboard())
+    return callback.answer()
+
+
+@dp.callback_query(F.data.startswith("sellall_"))
+async def sellall_confirm(callback: types.CallbackQuery):
+    target = callback.data.split("_")[1]
+    rarity = None if target == "all" else int(target)
+    # Кэш клавиатуры подтверждения держит запись на значение: только известные редкости
+    if rarity is not None and rarity not in RARITIES:
+        return callback.answer()
+    collection = await get_collection(callback.from_user.id)
+    if rarity is None:
+        title = "всех редкостей"
+        phones = sum(count for count, _ in collection.values())
+        value = sum(total for _, total in collection.values())
+    else:
+        title = RARITIES[rarity]['name']
+        phones, value = collection.get(rarity, (0, 0))
+    if not phones:
+        return callback.answer("❌ Нет телефонов для продажи!", show_alert=True)
+    await callback.message.edit_text(
+        f"💰 <b>Продать все телефоны {title}?</b>\n\n"
+        f"📱 Телефонов: {phones:,}\n"
+        f"💸 Вы получите: {int(value * 0.75):,} ТОчек",
+        reply_markup=sellall_confirm_keyboard(rarity)
     )
+    return callback.answer()
 
 
-@dp.message(F.text.in_(["/pay", "п", "p", "П", "P"]))
+@dp.callback_query(F.data.startswith("sellallok_"))
+async def sellall_execute(callback: types.CallbackQuery):
+    target = callback.data.split("_")[1]
+    rarity = None if target == "all" else int(target)
+    count, sell_price, balance = await sell_all_phones(callback.from_user.id, rarity)
+    if not count:
+        return callback.answer("❌ Нет телефонов для продажи!", show_alert=True)
+    await callback.message.edit_text(
+        f"💰 <b>Продано!</b>\n\n"
+        f"📱 Телефонов: {count:,}\n"
+        f"💸 Получено: {sell_price:,} ТОчек\n"
+        f"💵 Ваш баланс: {balance:,} ТОчек"
+    )
+    return callback.answer()
+
+
+@aliases.register("/pay", "п", "p", "П", "P", args=True)
 async def pay_command(message: types.Message):
     args = message.text.split()
     if len(args) < 3:
@@ -1016,15 +2831,13 @@ async def pay_command(message: types.Message):
         await message.answer("❌ Минимум 1 ТОчек!")
         return
     user_id = message.from_user.id
-    points = get_points(user_id)
-    if points < amount:
+    # Предпроверка до записи: сумма больше INTEGER SQLite иначе упала бы в writer.
+    # Окончательное решение всё равно за условным списанием в transfer_points
+    points = await get_points(user_id)
+    if amount > points:
         await message.answer(f"❌ Недостаточно ТОчек! У вас: {points:,}")
         return
-    conn = sqlite3.connect('phones_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id FROM users WHERE username = ?', (target_username,))
-    target = cursor.fetchone()
-    conn.close()
+    target = await find_user_by_username(target_username)
     if not target:
         await message.answer(f"❌ Пользователь @{target_username} не найден!")
         return
@@ -1032,12 +2845,14 @@ async def pay_command(message: types.Message):
     if target_id == user_id:
         await message.answer("❌ Нельзя перевести самому себе!")
         return
-    update_points(user_id, -amount)
-    update_points(target_id, amount)
+    balance = await transfer_points(user_id, target_id, amount)
+    if balance is None:
+        await message.answer(f"❌ Недостаточно ТОчек! У вас: {await get_points(user_id):,}")
+        return
     await message.answer(
         f"✅ <b>Перевод выполнен!</b>\n\n"
         f"💸 Отправлено @{target_username}: {amount:,} ТОчек\n"
-        f"💰 Ваш баланс: {get_points(user_id):,} ТОчек"
+        f"💰 Ваш баланс: {balance:,} ТОчек"
     )
     try:
         await bot.send_message(
@@ -1045,13 +2860,13 @@ async def pay_command(message: types.Message):
             f"💰 <b>Вам перевели ТОчки!</b>\n\n"
             f"От: @{message.from_user.username}\n"
             f"Сумма: {amount:,} ТОчек\n"
-            f"💵 Ваш баланс: {get_points(target_id):,} ТОчек"
+            f"💵 Ваш баланс: {await get_points(target_id):,} ТОчек"
         )
     except:
         pass
 
 
-@dp.message(F.text.in_(["/paycoin", "пк", "pc", "ПК", "PC"]))
+@aliases.register("/paycoin", "пк", "pc", "ПК", "PC", args=True)
 async def paycoin_command(message: types.Message):
     args = message.text.split()
     if len(args) < 3:
@@ -1074,7 +2889,7 @@ async def paycoin_command(message: types.Message):
     )
 
 
-@dp.message(F.text.in_(["/trade", "тр", "tr", "ТР", "TR"]))
+@aliases.register("/trade", "тр", "tr", "ТР", "TR", args=True)
 async def trade_command(message: types.Message):
     args = message.text.split()
     if len(args) < 2:
@@ -1087,11 +2902,7 @@ async def trade_command(message: types.Message):
         )
         return
     target_username = args[1].replace('@', '')
-    conn = sqlite3.connect('phones_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id FROM users WHERE username = ?', (target_username,))
-    target = cursor.fetchone()
-    conn.close()
+    target = await find_user_by_username(target_username)
     if not target:
         await message.answer(f"❌ Пользователь @{target_username} не найден!")
         return
@@ -1102,14 +2913,14 @@ async def trade_command(message: types.Message):
     )
 
 
-@dp.message(F.text.in_(["/tfarm", "тф", "tf", "ТФ", "TF", "ТМайнинг", "тмайнинг"]))
+@aliases.register("/tfarm", "тф", "tf", "ТФ", "TF", "ТМайнинг", "тмайнинг", "⛏️ ТМайнинг")
 async def farm_command(message: types.Message):
     user_id = message.from_user.id
-    user = get_user(user_id)
+    user = await get_user(user_id)
     if not user:
         await message.answer("❌ Используйте /start сначала!")
         return
-    farm_income = user[7]
+    farm_income = user.farm_income
     await message.answer(
         f"⛏️ <b>Ваша майнинг ферма</b>\n\n"
         f"💰 Доход в сутки: {farm_income:,} ТОчек\n"
@@ -1118,7 +2929,7 @@ async def farm_command(message: types.Message):
     )
 
 
-@dp.message(F.text.in_(["/event", "ев", "ev", "ЕВ", "EV"]))
+@aliases.register("/event", "ев", "ev", "ЕВ", "EV")
 async def event_command(message: types.Message):
     await message.answer(
         "🎉 <b>РОЗЫГРЫШ</b>\n\n"
@@ -1127,16 +2938,12 @@ async def event_command(message: types.Message):
     )
 
 
-@dp.message(F.text.in_(["/avito", "ав", "av", "АВ", "AV", "авито"]))
+@aliases.register("/avito", "ав", "av", "АВ", "AV", "авито", args=True)
 async def avito_command(message: types.Message):
     args = message.text.split()
     if len(args) > 1 and args[1].startswith('@'):
         username = args[1].replace('@', '')
-        conn = sqlite3.connect('phones_bot.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id, first_name FROM users WHERE username = ?', (username,))
-        target = cursor.fetchone()
-        conn.close()
+        target = await find_user_by_username(username)
         if not target:
             await message.answer(f"❌ Пользователь @{username} не найден!")
             return
@@ -1147,12 +2954,6 @@ async def avito_command(message: types.Message):
             f"Здесь будут объявления игрока {first_name}"
         )
         return
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📱 Все объявления", callback_data="avito_all")],
-        [InlineKeyboardButton(text="➕ Разместить объявление", callback_data="avito_create")],
-        [InlineKeyboardButton(text="📋 Мои объявления", callback_data="avito_my")],
-        [InlineKeyboardButton(text="🔍 Поиск по игроку", callback_data="avito_search")]
-    ])
     await message.answer(
         "🏪 <b>Вторичный рынок (Авито)</b>\n\n"
         "⏳ Функция в разработке...\n\n"
@@ -1163,11 +2964,11 @@ async def avito_command(message: types.Message):
         "• Просматривать объявления игроков\n\n"
         "💡 Используйте: <code>/avito @username</code>\n"
         "чтобы посмотреть объявления игрока",
-        reply_markup=keyboard
+        reply_markup=avito_keyboard()
     )
 
 
-@dp.message(F.text.in_(["/achievements", "достижения", "Достижения"]))
+@aliases.register("/achievements", "достижения", "Достижения")
 async def achievements_command(message: types.Message):
     await message.answer(
         "🏆 <b>ДОСТИЖЕНИЯ</b>\n\n"
@@ -1180,15 +2981,8 @@ async def achievements_command(message: types.Message):
     )
 
 
-@dp.message(F.text.in_(["/donate", "донат", "Донат"]))
+@aliases.register("/donate", "донат", "Донат")
 async def donate_command(message: types.Message):
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⭐ VIP статус - 100₽", callback_data="donate_vip")],
-        [InlineKeyboardButton(text="💎 Premium статус - 300₽", callback_data="donate_premium")],
-        [InlineKeyboardButton(text="👑 Legendary статус - 500₽", callback_data="donate_legendary")],
-        [InlineKeyboardButton(text="💰 Пакет ТОчек - от 50₽", callback_data="donate_points")],
-        [InlineKeyboardButton(text="🎴 Эксклюзивный телефон - 200₽", callback_data="donate_phone")]
-    ])
     await message.answer(
         "💎 <b>КАТАЛОГ ДОНАТА</b>\n\n"
         "<b>⭐ VIP статус (100₽):</b>\n"
@@ -1207,18 +3001,12 @@ async def donate_command(message: types.Message):
         "• Telegram Stars ⭐\n"
         "• Криптовалюта (USDT) 💎\n\n"
         "⚠️ Система доната в разработке!",
-        reply_markup=keyboard
+        reply_markup=donate_keyboard()
     )
 
 
-@dp.message(F.text.in_(["/roulette", "рулетка", "Рулетка"]))
+@aliases.register("/roulette", "рулетка", "Рулетка")
 async def roulette_command(message: types.Message):
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🎰 Крутить (10 ТОчек)", callback_data="spin_roulette_10")],
-        [InlineKeyboardButton(text="🎰 Крутить (100 ТОчек)", callback_data="spin_roulette_100")],
-        [InlineKeyboardButton(text="🎰 Крутить (1000 ТОчек)", callback_data="spin_roulette_1000")],
-        [InlineKeyboardButton(text="💎 Крутить за T-Coins", callback_data="spin_roulette_coins")]
-    ])
     await message.answer(
         "🎰 <b>ДОНАТНАЯ РУЛЕТКА</b>\n\n"
         "Выиграйте:\n"
@@ -1227,37 +3015,22 @@ async def roulette_command(message: types.Message):
         "• 💎 T-Coins\n"
         "• 🏆 Эксклюзивные награды\n\n"
         "⚠️ Функция в разработке!",
-        reply_markup=keyboard
+        reply_markup=roulette_keyboard()
     )
 
 
-@dp.message(F.text.in_(["/tconfig", "тконфиг", "ТКонфиг"]))
+@aliases.register("/tconfig", "тконфиг", "ТКонфиг")
 async def tconfig_command(message: types.Message):
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔔 Уведомления", callback_data="config_notifications")],
-        [InlineKeyboardButton(text="🎨 Тема оформления", callback_data="config_theme")],
-        [InlineKeyboardButton(text="🌐 Язык", callback_data="config_language")],
-        [InlineKeyboardButton(text="🔒 Приватность", callback_data="config_privacy")],
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_main")]
-    ])
     await message.answer(
         "⚙️ <b>КОНФИГУРАЦИЯ</b>\n\n"
         "Настройте бота под себя:",
-        reply_markup=keyboard
+        reply_markup=tconfig_keyboard()
     )
 
 
-@dp.message(F.text.in_(["/tinfo", "тинфо", "ТИнфо"]))
+@aliases.register("/tinfo", "тинфо", "ТИнфо")
 async def tinfo_command(message: types.Message):
-    conn = sqlite3.connect('phones_bot.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM users')
-    total_users = cursor.fetchone()[0]
-    cursor.execute('SELECT COUNT(*) FROM user_phones')
-    total_phones = cursor.fetchone()[0]
-    cursor.execute('SELECT SUM(points) FROM users')
-    total_points = cursor.fetchone()[0] or 0
-    conn.close()
+    total_users, total_phones, total_points = await get_bot_stats()
     await message.answer(
         f"ℹ️ <b>Техническая информация</b>\n\n"
         f"👥 Пользователей: {total_users:,}\n"
@@ -1268,7 +3041,97 @@ async def tinfo_command(message: types.Message):
     )
 
 
-@dp.message(F.text.in_(["/ping", "пинг", "Пинг"]))
+@dp.message(Command("dbcheck"))
+async def dbcheck_command(message: types.Message):
+    """Проверка агрегатов коллекции (только для админов): /dbcheck [fix]"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    mismatches = await check_collection()
+    if not mismatches:
+        await message.answer("✅ Агрегаты коллекций совпадают с user_phones")
+        return
+    text = f"⚠️ <b>Расхождений:</b> {len(mismatches)}\n\n"
+    for user_id, rarity, actual, stored in mismatches[:10]:
+        text += f"• {user_id} / {rarity}: факт {actual[0]} шт. {actual[1]:,}, в агрегатах {stored[0]} шт. {stored[1]:,}\n"
+    if "fix" in message.text.split()[1:]:
+        await rebuild_collection({user_id for user_id, *_ in mismatches})
+        text += "\n🔧 Агрегаты пересчитаны"
+    await message.answer(text)
+
+
+@dp.message(Command("broadcast"))
+async def broadcast_command(message: types.Message, state: FSMContext):
+    """Рассылка всем игрокам (только для админов): /broadcast [status|stop]"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    args = message.text.split()[1:]
+    if args and args[0] == "stop":
+        broadcast_id = await broadcaster.cancel()
+        await message.answer(f"🛑 Рассылка #{broadcast_id} остановлена" if broadcast_id
+                             else "ℹ️ Рассылка не идёт")
+        return
+    if broadcaster.running:
+        sent, failed, blocked = broadcaster.progress
+        await message.answer(
+            f"📢 <b>Идёт рассылка #{broadcaster.broadcast_id}</b>\n\n"
+            f"✅ Доставлено: {sent:,}\n"
+            f"❌ Ошибок: {failed:,}\n"
+            f"🚫 Заблокировали бота: {blocked:,}\n\n"
+            f"Остановить: <code>/broadcast stop</code>"
+        )
+        return
+    if args and args[0] == "status":
+        await message.answer("ℹ️ Рассылка не идёт")
+        return
+    await state.set_state(BotStates.admin_broadcast)
+    await message.answer("📢 Отправьте сообщение для рассылки всем игрокам или /cancel для отмены")
+
+
+@dp.message(BotStates.admin_broadcast)
+async def broadcast_message(message: types.Message, state: FSMContext):
+    await state.clear()
+    if message.text == "/cancel":
+        await message.answer("❌ Рассылка отменена")
+        return
+    broadcast_id = await broadcaster.start(message.from_user.id, message.chat.id, message.message_id)
+    if broadcast_id is None:
+        await message.answer("❌ Уже идёт другая рассылка")
+        return
+    await message.answer(f"📢 Рассылка #{broadcast_id} запущена")
+
+
+@dp.message(Command("reloadcatalog"))
+async def reloadcatalog_command(message: types.Message):
+    """Перечитать catalog.json без перезапуска (только для админов)"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    try:
+        new = reload_catalog()
+    except (CatalogError, OSError) as e:
+        await message.answer(f"❌ Каталог не перезагружен, работаю со старым:\n<code>{e}</code>")
+        return
+    await message.answer(
+        f"📦 Каталог перезагружен\n\n"
+        f"🎨 Редкостей: {len(new.rarities)}\n"
+        f"📱 Моделей: {sum(len(models) for models in new.phones.values())}"
+    )
+
+
+@dp.message(Command("floodstats"))
+async def floodstats_command(message: types.Message):
+    """Счётчики антифлуда (только для админов)"""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    shed = "\n".join(f"• {kind}: {count:,}" for kind, count in antiflood.shed.most_common()) or "• нет"
+    await message.answer(
+        f"🛡 <b>Антифлуд</b>\n\n"
+        f"✅ Пропущено: {antiflood.passed:,}\n"
+        f"👥 Активных вёдер: {antiflood.tracked:,}\n\n"
+        f"🚫 Отброшено:\n{shed}"
+    )
+
+
+@aliases.register("/ping", "пинг", "Пинг")
 async def ping_command(message: types.Message):
     start = datetime.now()
     msg = await message.answer("🏓 Понг!")
@@ -1277,7 +3140,7 @@ async def ping_command(message: types.Message):
     await msg.edit_text(f"🏓 Понг!\n⏱ {diff:.0f}ms")
 
 
-@dp.message(F.text.in_(["Помощь", "помощь", "/help", "км", "h", "КМ", "H"]))
+@aliases.register("Помощь", "помощь", "/help", "км", "h", "КМ", "H")
 async def help_command(message: types.Message):
     await message.answer(
         "<b>📖 СПИСОК КОМАНД</b>\n\n"
@@ -1308,7 +3171,7 @@ async def help_command(message: types.Message):
 @dp.callback_query(F.data == "back_main")
 async def back_main(callback: types.CallbackQuery):
     await callback.message.delete()
-    await callback.answer()
+    return callback.answer()
 
 
 @dp.callback_query(F.data == "back_shop")
@@ -1317,7 +3180,7 @@ async def back_shop(callback: types.CallbackQuery):
         "🏪 <b>Магазин телефонов</b>\n\nВыберите редкость:",
         reply_markup=shop_keyboard()
     )
-    await callback.answer()
+    return callback.answer()
 
 
 @dp.callback_query(F.data == "back_myphones")
@@ -1326,51 +3189,464 @@ async def back_myphones(callback: types.CallbackQuery):
         "📱 <b>Мои телефоны</b>\n\nВыберите редкость:",
         reply_markup=rarity_select_keyboard()
     )
-    await callback.answer()
+    return callback.answer()
+
+
+# Регистрируется последним: команды и состояния FSM проверяются раньше
+@dp.message(F.text, aliases.filter)
+async def dispatch_alias(message: types.Message, alias_handler):
+    return await alias_handler(message)
+
+
+# ==================== СИМУЛЯТОР ЭКОНОМИКИ ====================
+
+CARDS_PER_DAY = 24 // 3
+DAILY_REWARD = 100
+SELL_RATE = 0.75
+
+
+def simulate_economy(players: int = 100_000, days: int = 90, upgrade_share: float = 0.3,
+                     sell_share: float = 0.5, activity: float = 0.6, seed: int = None):
+    """Офлайн-симуляция экономики на таблицах RARITIES/PHONES_DB и правилах бота:
+    карточка раз в 3 часа, ежедневная награда, апгрейд с потерей телефона при
+    неудаче и продажа за 75%. Каждый день считается векторно по всем игрокам.
+
+    upgrade_share / sell_share - доля новых карточек, которые игрок пытается
+    улучшить / продаёт, activity - вероятность, что игрок забирает карточку
+    или награду. Возвращает словарь с итоговыми массивами и динамикой.
+    """
+    rng = np.random.default_rng(seed)
+    count = len(sampler.rarities)
+    max_models = max(len(sampler._prices[r]) for r in sampler.rarities)
+    prices = np.zeros((count, max(max_models, 1)), dtype=np.int64)
+    for column, rarity in enumerate(sampler.rarities):
+        prices[column, :len(sampler._prices[rarity])] = sampler._prices[rarity]
+    model_counts = sampler._np_counts
+    upgrade_chances = np.array([RARITIES[r]['upgrade_chance'] for r in sampler.rarities])
+    top_column = count - 1
+
+    points = np.full(players, 500, dtype=np.int64)
+    collection = np.zeros(players, dtype=np.int64)
+    held = np.zeros(count, dtype=np.int64)
+    dropped = np.zeros(count, dtype=np.int64)
+    upgrades = np.zeros(2, dtype=np.int64)  # успехи, неудачи
+    supply = []
+
+    for _ in range(days):
+        points += DAILY_REWARD * (rng.random(players) < activity)
+        cards = rng.binomial(CARDS_PER_DAY, activity, size=players)
+        owners = np.repeat(np.arange(players), cards)
+        columns, models = sampler.draw_arrays(owners.size, rng)
+        dropped += np.bincount(columns, minlength=count)
+
+        trying = (rng.random(owners.size) < upgrade_share) & (columns < top_column)
+        success = trying & (rng.random(owners.size) * 100 < upgrade_chances[columns])
+        failed = trying & ~success
+        upgrades += (success.sum(), failed.sum())
+        columns = np.where(success, columns + 1, columns)
+        models = np.where(success, rng.integers(0, np.maximum(model_counts[columns], 1)), models)
+        values = prices[columns, models]
+
+        alive = ~failed
+        sold = alive & (rng.random(owners.size) < sell_share)
+        kept = alive & ~sold
+        points += np.bincount(owners[sold], weights=(values[sold] * SELL_RATE).astype(np.int64),
+                              minlength=players).astype(np.int64)
+        collection += np.bincount(owners[kept], weights=values[kept], minlength=players).astype(np.int64)
+        held += np.bincount(columns[kept], minlength=count)
+        supply.append(int(points.sum()))
+
+    return {
+        'points': points, 'collection': collection, 'held': held, 'dropped': dropped,
+        'upgrades': upgrades, 'supply': supply,
+    }
+
+
+def print_simulation_report(result, players: int, days: int):
+    points = result['points']
+    wealth = np.sort(points + result['collection'])
+    gini = 1 - 2 * np.sum(np.cumsum(wealth)) / (wealth.size * wealth.sum()) + 1 / wealth.size
+    print(f"📊 {players:,} игроков × {days} дней = {players * days:,} игроко-дней\n")
+    print("💰 ТОчки на руках:")
+    for q in (10, 50, 90, 99):
+        print(f"   p{q}: {int(np.percentile(points, q)):,}")
+    print(f"   max: {int(points.max()):,}")
+    print(f"📈 Всего ТОчек: {result['supply'][0]:,} после 1-го дня → {result['supply'][-1]:,}")
+    print(f"⚖️ Джини (ТОчки + коллекция): {gini:.3f}")
+    success, failed = result['upgrades']
+    print(f"⬆️ Апгрейдов: {success + failed:,}, успешных {success / max(success + failed, 1):.1%}\n")
+    print("🎴 Выпало / в коллекциях:")
+    for column, rarity in enumerate(sampler.rarities):
+        share = result['dropped'][column] / max(result['dropped'].sum(), 1)
+        print(f"   {RARITIES[rarity]['name']}: {result['dropped'][column]:,} ({share:.4%}) / {result['held'][column]:,}")
+
+
+def _chi2_critical(df: int, z: float = 3.09) -> float:
+    """Критическое значение хи-квадрат (по умолчанию p = 0.001), приближение Уилсона-Хилферти"""
+    return df * (1 - 2 / (9 * df) + z * math.sqrt(2 / (9 * df))) ** 3
+
+
+def _chi2(observed, expected) -> float:
+    return sum((o - e) ** 2 / e for o, e in zip(observed, expected) if e > 0)
+
+
+def check_drop_rates(samples: int = 1_000_000) -> bool:
+    """Статистические проверки, что живые calculate_rarity, get_random_phone и
+    roll_upgrade выдают настроенные вероятности. Печатает отчёт, возвращает успех."""
+    ok = True
+
+    def report(name: str, statistic: float, df: int):
+        nonlocal ok
+        critical = _chi2_critical(df)
+        passed = statistic <= critical
+        ok &= passed
+        print(f"{'✅' if passed else '❌'} {name}: χ²={statistic:.2f} (df={df}, порог {critical:.2f})")
+
+    rarities = sorted(RARITIES)
+    counts = Counter(calculate_rarity() for _ in range(samples))
+    total_chance = sum(RARITIES[r]['chance'] for r in rarities)
+    expected = [samples * RARITIES[r]['chance'] / total_chance for r in rarities]
+    report("calculate_rarity", _chi2([counts[r] for r in rarities], expected), len(rarities) - 1)
+
+    for rarity in rarities:
+        models = PHONES_DB.get(rarity, ())
+        if len(models) < 2:
+            continue
+        draws = samples // 10
+        counts = Counter(get_random_phone(rarity).id for _ in range(draws))
+        report(f"get_random_phone({rarity})", _chi2([counts[m.id] for m in models], [draws / len(models)] * len(models)),
+               len(models) - 1)
+
+    for rarity in rarities:
+        chance = RARITIES[rarity]['upgrade_chance'] / 100
+        if not 0 < chance < 1:
+            continue
+        trials = samples // 10
+        wins = sum(roll_upgrade(rarity) for _ in range(trials))
+        report(f"roll_upgrade({rarity})", _chi2([wins, trials - wins], [trials * chance, trials * (1 - chance)]), 1)
+    return ok
+
+
+def run_simulator(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Симулятор экономики Phones Collection Bot")
+    parser.add_argument('--simulate', action='store_true')
+    parser.add_argument('--players', type=int, default=100_000)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--upgrade-share', type=float, default=0.3)
+    parser.add_argument('--sell-share', type=float, default=0.5)
+    parser.add_argument('--activity', type=float, default=0.6)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--check-samples', type=int, default=1_000_000)
+    args = parser.parse_args(argv)
+    if np is None:
+        print("📦 Для симулятора нужен numpy: pip install numpy")
+        return 1
+    if args.seed is not None:
+        random.seed(args.seed)
+    started = time.perf_counter()
+    result = simulate_economy(args.players, args.days, args.upgrade_share, args.sell_share,
+                              args.activity, args.seed)
+    print_simulation_report(result, args.players, args.days)
+    print(f"\n⏱ Симуляция: {time.perf_counter() - started:.1f} с\n")
+    return 0 if check_drop_rates(args.check_samples) else 1
 
 
 # ==================== ЗАПУСК ====================
 
-async def main():
-    init_db()
-    logger.info("🚀 Phones Collection Bot запущен!")
-    await dp.start_polling(bot)
+class UpdateTracker(BaseMiddleware):
+    """Внешний middleware на все апдейты: какие сейчас в работе.
+    По нему остановка вебхука дожидается начатых апдейтов."""
 
+    def __init__(self):
+        self.in_flight = set()
+        self._idle = asyncio.Event()
+        self._idle.set()
 
-if __name__ == '__main__':
-    import sys
-    import subprocess
-    import time
+    async def __call__(self, handler, event, data):
+        self.in_flight.add(event.update_id)
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight.discard(event.update_id)
+            if not self.in_flight:
+                self._idle.set()
+
+    async def drain(self, timeout: float) -> bool:
+        """Ждёт завершения начатых апдейтов не дольше timeout секунд"""
+        if self.in_flight:
+            logger.info(f"⏳ Дожидаюсь апдейтов в работе: {len(self.in_flight)}")
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            logger.warning(f"⏳ Не дождались апдейтов за {timeout:.0f} с: {sorted(self.in_flight)}")
+            return False
+
+
+tracker = UpdateTracker()
+dp.update.outer_middleware(tracker)
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Вебхук с ограниченной параллельностью и обратным давлением.
+
+    Одновременно обрабатывается не больше max_concurrency апдейтов, ещё
+    max_pending ждут своей очереди; сверх этого отвечаем 503, и Telegram
+    повторит доставку позже. Апдейты обрабатываются прямо в запросе, поэтому
+    метод, который вернул хендлер (например, callback.answer()), уходит
+    в Telegram ответом на вебхук без отдельного запроса к API.
+
+    Ошибка хендлера тоже отвечается 200, как в поллинге: иначе Telegram
+    повторит апдейт, и уже записанное в базу (покупка, продажа) выполнится дважды.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_concurrency: int, max_pending: int, **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=False, **kwargs)
+        self.max_pending = max_pending
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._pending = 0
+        self.rejected = 0
+        self.failed = 0
+        self.draining = False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.draining or self._pending >= self.max_pending:
+            self.rejected += 1
+            return web.Response(status=503, text="Busy")
+        self._pending += 1
+        try:
+            async with self._semaphore:
+                return await super().handle(request)
+        except Exception:
+            # Dispatcher уже записал исключение в лог
+            self.failed += 1
+            return web.json_response({})
+        finally:
+            self._pending -= 1
+
+
+def stop_event() -> asyncio.Event:
+    """Событие, которое выставят SIGTERM (сигнал супервизора) или SIGINT"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    return stop
+
+
+async def process_update(update: types.Update):
+    """Апдейт из getUpdates. Метод, который вернул хендлер (callback.answer(...)),
+    отправляется отдельным запросом, как в dp.start_polling: feed_update его только
+    возвращает, а в вебхуке он уходит в теле ответа"""
+    result = await dp.feed_update(bot, update)
+    if isinstance(result, TelegramMethod):
+        await dp.silent_call_request(bot, result)
+
+
+async def run_polling():
+    """Свой цикл getUpdates вместо dp.start_polling, чтобы остановка была управляемой.
+
+    Апдейты обрабатываются задачами, не больше POLLING_CONCURRENCY сразу. Как и
+    в aiogram, offset следующего getUpdates подтверждает апдейт, как только его
+    задача запущена, поэтому начатый апдейт Telegram повторно уже не пришлёт.
+    По SIGTERM/SIGINT сначала перестаём запрашивать апдейты, затем ждём начатые
+    не дольше DRAIN_TIMEOUT, а не успевшие отменяем до сброса write_behind и
+    закрытия базы - такие апдейты теряются. Полученные, но не запущенные
+    апдейты не подтверждаются и достанутся следующему процессу.
+    """
+    await bot.delete_webhook()
+    stop = stop_event()
+    stopping = asyncio.create_task(stop.wait())
+    semaphore = asyncio.Semaphore(POLLING_CONCURRENCY)
+    tasks = set()
+    offset = None
+    allowed_updates = dp.resolve_used_update_types()
+
+    async def process(update: types.Update):
+        try:
+            await process_update(update)
+        except Exception:
+            logger.exception(f"Ошибка при обработке апдейта {update.update_id}")
+        finally:
+            semaphore.release()
+
+    async def until_stopped(aw) -> bool:
+        """Ждёт aw, пока не пришёл сигнал остановки; False - остановка, aw отменён"""
+        task = asyncio.ensure_future(aw)
+        await asyncio.wait((task, stopping), return_when=asyncio.FIRST_COMPLETED)
+        if not task.done():
+            task.cancel()
+            return False
+        return True
 
-    if len(sys.argv) == 1:
+    try:
+        while not stop.is_set():
+            fetch = asyncio.ensure_future(bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT,
+                                                          allowed_updates=allowed_updates))
+            if not await until_stopped(fetch):
+                break
+            try:
+                updates = fetch.result()
+            except Exception as e:
+                logger.error(f"Не удалось получить апдейты: {e}")
+                await until_stopped(asyncio.sleep(5))
+                continue
+            for update in updates:
+                if not await until_stopped(semaphore.acquire()):
+                    break
+                offset = update.update_id + 1
+                task = asyncio.create_task(process(update))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        if tasks:
+            logger.info(f"⏳ Дожидаюсь апдейтов в работе: {len(tasks)}")
+            _, pending = await asyncio.wait(tasks, timeout=DRAIN_TIMEOUT)
+            if pending:
+                logger.warning(f"⏳ Не дождались за {DRAIN_TIMEOUT:.0f} с, отменяю апдейтов: {len(pending)}")
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+        if offset is not None:
+            # Подтверждаем запущенные апдейты, иначе следующий процесс получит их повторно
+            await bot.get_updates(offset=offset, limit=1, timeout=0)
+    finally:
+        stopping.cancel()
+        await bot.session.close()
+
+
+async def run_webhook():
+    app = web.Application()
+    handler = BoundedRequestHandler(
+        dp, bot,
+        max_concurrency=WEBHOOK_CONCURRENCY,
+        max_pending=WEBHOOK_MAX_PENDING,
+        secret_token=WEBHOOK_SECRET or None,
+    )
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    # После drain запросы, не уложившиеся в DRAIN_TIMEOUT, отменяются при cleanup()
+    runner = web.AppRunner(app, shutdown_timeout=1.0)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info(f"🌐 Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            max_connections=min(WEBHOOK_CONCURRENCY, 100),
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    try:
+        await stop_event().wait()
+        # Новые апдейты получают 503 и остаются у Telegram до следующего процесса
+        handler.draining = True
+        await tracker.drain(DRAIN_TIMEOUT)
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
+
+
+async def bootstrap():
+    """Разовая настройка при запуске: команды и профиль бота вместо запросов на каждый /start"""
+    global bot_profile
+    await bot.set_my_commands(BOT_COMMANDS)
+    bot_profile = await bot.get_me()
+    logger.info(f"🤖 @{bot_profile.username} (id {bot_profile.id})")
+
+
+async def main(webhook: bool = False):
+    await init_db()
+    await load_leaderboard()
+    await bootstrap()
+    await media.load()
+    build_keyboards()
+    catalog_watcher = asyncio.create_task(watch_catalog())
+    write_behind.start()
+    await broadcaster.resume()
+    logger.info("🚀 Phones Collection Bot запущен!")
+    try:
+        if webhook:
+            await run_webhook()
+        else:
+            await run_polling()
+    finally:
+        catalog_watcher.cancel()
+        await broadcaster.stop()
+        # Записи отменённых хендлеров уже в очереди писателя и могут добавить приращения
+        await db.sync()
+        await write_behind.stop()
+        db.close()
+        logger.info("🛑 Бот остановлен, очередь записей сброшена")
+
+
+def supervise(worker_args):
+    """Перезапуск бота при изменении кода без потери апдейтов.
+
+    Старому процессу отправляется SIGTERM: он перестаёт брать апдейты,
+    дорабатывает начатые (не дольше DRAIN_TIMEOUT), сбрасывает записи в базу
+    и выходит. Только после этого запускается новый. Изменения файла ловит
+    watchfiles (inotify), без него - опрос mtime раз в секунду.
+    """
+    path = os.path.abspath(__file__)
+
+    def start():
+        return subprocess.Popen([sys.executable, path, '--running', *worker_args])
+
+    def stop(process):
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(DRAIN_TIMEOUT + 10)
+        except subprocess.TimeoutExpired:
+            print("⚠️ Бот не остановился вовремя, завершаю принудительно")
+            process.kill()
+            process.wait()
+
+    def changes():
+        """True - файл изменился, False - просто прошла секунда"""
         try:
             import watchfiles
-            print("🔥 Hot Reload активирован!")
-
-            def run_bot():
-                return subprocess.Popen([sys.executable, __file__, '--running'])
+        except ImportError:
+            watchfiles = None
+        if watchfiles is not None:
+            for batch in watchfiles.watch(os.path.dirname(path), yield_on_timeout=True, rust_timeout=1000,
+                                          watch_filter=lambda change, changed: os.path.abspath(changed) == path):
+                yield bool(batch)
+            return
+        last_mtime = os.path.getmtime(path)
+        while True:
+            time.sleep(1)
+            mtime = os.path.getmtime(path)
+            yield mtime != last_mtime
+            last_mtime = mtime
+
+    print("🔥 Hot Reload активирован!")
+    process = start()
+    try:
+        for changed in changes():
+            if changed:
+                print("🔄 Изменения обнаружены! Дожидаюсь остановки бота...")
+                stop(process)
+                process = start()
+            elif process.poll() is not None:
+                print(f"💥 Бот завершился с кодом {process.returncode}, перезапуск через 5 с")
+                time.sleep(5)
+                process = start()
+    except KeyboardInterrupt:
+        print("\n🛑 Остановка...")
+        stop(process)
 
-            process = run_bot()
-            last_mtime = os.path.getmtime(__file__)
 
-            try:
-                while True:
-                    time.sleep(1)
-                    current_mtime = os.path.getmtime(__file__)
-                    if current_mtime != last_mtime:
-                        print("🔄 Изменения обнаружены! Перезапуск...")
-                        process.terminate()
-                        process.wait()
-                        last_mtime = current_mtime
-                        process = run_bot()
-            except KeyboardInterrupt:
-                print("\n🛑 Остановка...")
-                process.terminate()
-                process.wait()
-        except ImportError:
-            print("📦 Устанавливаю watchfiles...")
-            subprocess.check_call([sys.executable, "-m", "pip", "install", "watchfiles", "-q"])
-            print("✅ Установлено! Перезапускаю...")
-            os.execv(sys.executable, [sys.executable] + sys.argv)
+if __name__ == '__main__':
+    if '--simulate' in sys.argv:
+        sys.exit(run_simulator(sys.argv[1:]))
+    elif len(sys.argv) == 1 or '--supervise' in sys.argv:
+        supervise([arg for arg in sys.argv[1:] if arg != '--supervise'])
     else:
-        asyncio.run(main())
+        asyncio.run(main(webhook='--webhook' in sys.argv))
@@ -0,0 +1,17 @@
+"""Загрузка бота для бенчмарков: тестовый токен и отдельная временная база"""
+import importlib.util
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_bot():
+    os.environ['PHONES_BOT_TOKEN'] = '42:BENCH'
+    os.environ['PHONES_BOT_DB'] = os.path.join(tempfile.mkdtemp(prefix='phones-bot-bench-'), 'bot.db')
+    spec = importlib.util.spec_from_file_location('phones_bot', os.path.join(ROOT, 'Phones collection bot.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['phones_bot'] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,92 @@
+"""Задержка диспетчеризации текстовой команды: цепочка фильтров F.text.in_
+(как до AliasRouter) против одного поиска в AliasRouter, при росте числа алиасов.
+Меряется feed_update целиком: синхронные фильтры aiogram вызывает через
+asyncio.to_thread, поэтому каждый фильтр цепочки - отдельный переход в поток.
+
+    python benchmarks/bench_alias_router.py
+"""
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+from aiogram import Dispatcher, F
+from aiogram.types import Update
+
+from _bot import load_bot
+
+bot = load_bot()
+# aiogram пишет в лог каждый апдейт - это не то, что мы меряем
+logging.getLogger('aiogram.event').setLevel(logging.WARNING)
+
+
+async def noop(message):
+    pass
+
+
+def alias_groups(scale: int):
+    """Группы алиасов хендлеров бота, размноженные scale раз"""
+    groups = defaultdict(list)
+    for alias, handler in bot.aliases._exact.items():
+        groups[handler].append(alias)
+    base = list(groups.values())
+    return [[f"{alias}{copy or ''}" for alias in group] for copy in range(scale) for group in base]
+
+
+def filter_chain(groups) -> Dispatcher:
+    dp = Dispatcher()
+    for group in groups:
+        dp.message.register(noop, F.text.in_(group))
+    return dp
+
+
+def alias_router(groups) -> Dispatcher:
+    dp = Dispatcher()
+    router = bot.AliasRouter()
+    for group in groups:
+        # Отдельная функция на группу: алиасы разных групп не должны конфликтовать
+        async def handler(message):
+            pass
+        router.register(*group)(handler)
+
+    async def dispatch(message, alias_handler):
+        return await alias_handler(message)
+
+    dp.message.register(dispatch, F.text, router.filter)
+    return dp
+
+
+def message(text: str) -> Update:
+    return Update.model_validate({'update_id': 1, 'message': {
+        'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'},
+        'from': {'id': 1, 'is_bot': False, 'first_name': 'u'}, 'text': text}})
+
+
+async def latency(dp: Dispatcher, update: Update, budget: float = 0.3) -> float:
+    """Лучшее среднее время feed_update из трёх замеров примерно по budget секунд"""
+    started = time.perf_counter()
+    await dp.feed_update(bot.bot, update)
+    number = max(10, int(budget / (time.perf_counter() - started)))
+    best = float('inf')
+    for _ in range(3):
+        started = time.perf_counter()
+        for _ in range(number):
+            await dp.feed_update(bot.bot, update)
+        best = min(best, (time.perf_counter() - started) / number)
+    return best
+
+
+async def main():
+    print(f"{'алиасов':>8} {'сообщение':<16} {'фильтры':>10} {'роутер':>9}", flush=True)
+    for scale in (1, 4, 16):
+        groups = alias_groups(scale)
+        chain, router = filter_chain(groups), alias_router(groups)
+        cases = [("последний алиас", groups[-1][0]), ("болтовня", "привет, как дела у всех?")]
+        for name, text in cases:
+            update = message(text)
+            print(f"{sum(map(len, groups)):8} {name:<16} {await latency(chain, update) * 1e6:8.0f}us "
+                  f"{await latency(router, update) * 1e6:7.0f}us", flush=True)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
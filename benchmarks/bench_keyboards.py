@@ -0,0 +1,53 @@
+"""Сколько стоит клавиатура на одно нажатие кнопки: сборка заново против кэша.
+
+    python benchmarks/bench_keyboards.py
+"""
+import timeit
+import tracemalloc
+
+from _bot import load_bot
+
+bot = load_bot()
+
+KEYBOARDS = [
+    ("main_keyboard()", bot.main_keyboard, ()),
+    ("shop_keyboard()", bot.shop_keyboard, ()),
+    ("rarity_select_keyboard()", bot.rarity_select_keyboard, ()),
+    ("upgrades_shop_keyboard()", bot.upgrades_shop_keyboard, ()),
+    ("shop_phones_keyboard(0, 0)", bot.shop_phones_keyboard, (0, 0)),
+    ("buy_confirm_keyboard(0, 1)", bot.buy_confirm_keyboard, (0, 1)),
+]
+
+
+def allocated(fn, args, calls: int = 200):
+    """(байт, блоков памяти) на один вызов: результаты держатся в списке, поэтому
+    считается вся собранная разметка; 8 байт из них - сама ссылка в списке"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    results = [fn(*args) for _ in range(calls)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    size = sum(stat.size_diff for stat in stats if stat.size_diff > 0)
+    blocks = sum(stat.count_diff for stat in stats if stat.count_diff > 0)
+    del results
+    return size / calls, blocks / calls
+
+
+def per_call(fn, args, number: int = 2000) -> float:
+    return min(timeit.repeat(lambda: fn(*args), number=number, repeat=5)) / number
+
+
+def main():
+    print(f"{'клавиатура':28} {'сборка':>10} {'кэш':>9} {'байт/вызов':>11} {'блоков':>7} {'из кэша':>8}")
+    for name, cached, args in KEYBOARDS:
+        build = cached.__wrapped__
+        cached(*args)
+        build_bytes, build_blocks = allocated(build, args)
+        cached_bytes, _ = allocated(cached, args)
+        print(f"{name:28} {per_call(build, args) * 1e6:8.1f}us {per_call(cached, args) * 1e6:7.2f}us "
+              f"{build_bytes:11,.0f} {build_blocks:7.0f} {cached_bytes:8,.0f}")
+
+
+if __name__ == '__main__':
+    main()
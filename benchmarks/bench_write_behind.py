@@ -0,0 +1,66 @@
+"""Коммиты в секунду: отдельная транзакция на каждую выданную карточку против write_behind.
+
+    python benchmarks/bench_write_behind.py [изменений] [игроков]
+"""
+import asyncio
+import sys
+import time
+
+from _bot import load_bot
+
+bot = load_bot()
+
+
+def add_card(conn, user_id: int):
+    conn.execute('UPDATE users SET cards = cards + 1, total_phones = total_phones + 1 WHERE user_id = ?',
+                 (user_id,))
+
+
+@bot.db.reader
+def total_cards(conn) -> int:
+    return conn.execute('SELECT SUM(cards) FROM users').fetchone()[0]
+
+
+async def per_update_commits(updates: int, players: int) -> float:
+    """Как до write_behind: каждое изменение - своя транзакция и свой коммит"""
+    started = time.perf_counter()
+    await asyncio.gather(*(bot.db.write(add_card, i % players) for i in range(updates)))
+    return time.perf_counter() - started
+
+
+async def write_behind_commits(updates: int, players: int):
+    """Изменения через write_behind, включая финальный сброс. Возвращает (секунд, коммитов)"""
+    queue = bot.WriteBehind()
+    queue.start()
+    started = time.perf_counter()
+    for i in range(updates):
+        queue.add(i % players, cards=1, total_phones=1)
+        if i % 100 == 0:
+            # Хендлеры отдают управление event loop между изменениями
+            await asyncio.sleep(0)
+    await queue.stop()
+    return time.perf_counter() - started, queue.flushes
+
+
+async def main(updates: int, players: int):
+    await bot.init_db()
+    for user_id in range(players):
+        await bot.create_user(user_id, f"p{user_id}", "Игрок")
+    before = await total_cards()
+
+    elapsed = await per_update_commits(updates, players)
+    print(f"по коммиту на изменение: {updates:,} коммитов за {elapsed:.2f} с - "
+          f"{updates / elapsed:,.0f} изменений/с, {updates / elapsed:,.0f} коммитов/с")
+
+    elapsed, flushes = await write_behind_commits(updates, players)
+    print(f"write_behind:            {flushes:,} коммитов за {elapsed:.2f} с - "
+          f"{updates / elapsed:,.0f} изменений/с, {flushes / elapsed:,.0f} коммитов/с, "
+          f"{updates / max(flushes, 1):,.0f} изменений на коммит")
+
+    assert await total_cards() == before + 2 * updates
+    bot.db.close()
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    asyncio.run(main(*(args + [20_000, 1_000][len(args):])))
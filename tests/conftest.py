@@ -0,0 +1,71 @@
+import asyncio
+import importlib.util
+import os
+import sys
+import tempfile
+
+import pytest
+from aiogram import types
+from aiogram.client.session.base import BaseSession
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Бот читает настройки при импорте: подставляем тестовый токен и отдельную базу
+os.environ['PHONES_BOT_TOKEN'] = '42:TEST'
+os.environ['PHONES_BOT_DB'] = os.path.join(tempfile.mkdtemp(prefix='phones-bot-tests-'), 'bot.db')
+
+
+def load_bot():
+    spec = importlib.util.spec_from_file_location('phones_bot', os.path.join(ROOT, 'Phones collection bot.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['phones_bot'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_message(chat_id: int = 1, message_id: int = 1, **fields) -> types.Message:
+    return types.Message.model_validate({'message_id': message_id, 'date': 0,
+                                         'chat': {'id': chat_id, 'type': 'private'}, **fields})
+
+
+def default_response(method):
+    """Send*/Edit* отвечают сообщением, остальные методы - True"""
+    if type(method).__name__.startswith(('Send', 'Edit')):
+        return make_message(getattr(method, 'chat_id', None) or 1)
+    return True
+
+
+class StubSession(BaseSession):
+    """Сессия без сети: запоминает вызванные методы, ответ даёт responder(method)"""
+
+    def __init__(self, responder=default_response):
+        super().__init__()
+        self.requests = []
+        self.responder = responder
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests.append(method)
+        return self.responder(method)
+
+    async def stream_content(self, *args, **kwargs):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture(scope='session')
+def bot_module():
+    module = load_bot()
+    asyncio.run(module.init_db())
+    yield module
+    module.db.close()
+
+
+@pytest.fixture
+def session(bot_module):
+    """Заглушка вместо сетевой сессии bot на время теста"""
+    original = bot_module.bot.session
+    bot_module.bot.session = StubSession()
+    yield bot_module.bot.session
+    bot_module.bot.session = original
@@ -0,0 +1,47 @@
+import asyncio
+
+from aiogram.types import Update
+
+
+def say(bot_module, user_id: int, text: str, username: str = 'u'):
+    update = Update.model_validate({'update_id': 1, 'message': {
+        'message_id': 1, 'date': 0, 'text': text, 'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'u', 'username': username}}})
+    return asyncio.run(bot_module.process_update(update))
+
+
+def replies(session):
+    return [request.text for request in session.requests if type(request).__name__ == 'SendMessage']
+
+
+def test_pay_rejects_amount_above_balance_before_writing(bot_module, session):
+    async def players():
+        await bot_module.create_user(40_000, 'payer', 'u')
+        await bot_module.create_user(40_001, 'payee', 'u')
+
+    asyncio.run(players())
+    balance = asyncio.run(bot_module.get_points(40_000))
+    # Сумма не влезает в INTEGER SQLite: раньше writer падал с OverflowError
+    say(bot_module, 40_000, "/pay @payee 100000000000000000000", 'payer')
+    assert replies(session) == [f"❌ Недостаточно ТОчек! У вас: {balance:,}"]
+    assert asyncio.run(bot_module.get_points(40_001)) == balance
+
+
+def test_short_aliases_with_arguments_need_a_username(bot_module, session):
+    say(bot_module, 40_100, "п привет")
+    say(bot_module, 40_101, "тр как дела")
+    assert replies(session) == []
+
+    resolve = bot_module.aliases.resolve
+    assert resolve("п @friend 100") is bot_module.pay_command
+    assert resolve("/pay friend 100") is bot_module.pay_command
+    assert resolve("П") is bot_module.pay_command
+
+
+def test_slash_commands_addressed_to_the_bot(bot_module):
+    resolve = bot_module.aliases.resolve
+    assert resolve("/pay@PhonesBot @friend 100", 'phonesbot') is bot_module.pay_command
+    assert resolve("/sellall@PhonesBot", 'PhonesBot') is resolve("/sellall")
+    assert resolve("/sellall") is not None
+    # Команда из меню другого бота в том же чате
+    assert resolve("/sellall@OtherBot", 'PhonesBot') is None
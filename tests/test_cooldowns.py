@@ -0,0 +1,18 @@
+def test_expired_cooldowns_are_evicted(bot_module):
+    cooldowns = bot_module.CooldownIndex(sweep_interval=100)
+    cooldowns.remaining(0, 1_000)
+    for user_id in range(1, 1_001):
+        cooldowns.set(user_id, 1_000 + user_id)
+    assert len(cooldowns) == 1_000
+
+    # Истёкшая запись уходит при чтении
+    assert cooldowns.remaining(1, 1_050) == 0
+    assert cooldowns.remaining(60, 1_050) == 10
+    assert len(cooldowns) == 999
+
+    # Остальные истёкшие - при следующей проверке после sweep_interval,
+    # даже если эти игроки больше не приходят
+    assert cooldowns.remaining(1_000, 1_100) == 900
+    assert len(cooldowns) == 900
+    assert cooldowns.remaining(5, 2_000) == 0
+    assert len(cooldowns) == 0
@@ -0,0 +1,59 @@
+import asyncio
+import sqlite3
+import time
+
+HEAVY_QUERY = '''WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+                 SELECT SUM(i) FROM n'''
+HEAVY_ROWS = 1_000_000
+TICK = 0.005
+
+
+def heavy(conn, rows: int) -> int:
+    return conn.execute(HEAVY_QUERY, (rows,)).fetchone()[0]
+
+
+async def measure_lag(work):
+    """(максимальная задержка тика event loop, длительность work) пока выполняется work"""
+    loop = asyncio.get_running_loop()
+    lags = []
+    done = asyncio.Event()
+
+    async def probe():
+        while not done.is_set():
+            started = loop.time()
+            await asyncio.sleep(TICK)
+            lags.append(loop.time() - started - TICK)
+
+    prober = asyncio.create_task(probe())
+    await asyncio.sleep(TICK * 4)
+    started = loop.time()
+    await work()
+    duration = loop.time() - started
+    done.set()
+    await prober
+    return max(lags), duration
+
+
+def test_heavy_queries_do_not_block_event_loop(bot_module):
+    db = bot_module.db
+
+    async def scenario():
+        idle_lag, _ = await measure_lag(lambda: asyncio.sleep(0.2))
+        busy_lag, duration = await measure_lag(lambda: asyncio.gather(
+            db.read(heavy, HEAVY_ROWS), db.read(heavy, HEAVY_ROWS), db.write(heavy, HEAVY_ROWS)))
+        return idle_lag, busy_lag, duration
+
+    idle_lag, busy_lag, duration = asyncio.run(scenario())
+
+    # Тот же запрос прямо в event loop блокирует его на всё время выполнения
+    conn = sqlite3.connect(db.path)
+    started = time.perf_counter()
+    heavy(conn, HEAVY_ROWS)
+    blocking = time.perf_counter() - started
+    conn.close()
+
+    print(f"\nлаг простоя {idle_lag * 1000:.1f} мс, под нагрузкой {busy_lag * 1000:.1f} мс "
+          f"за {duration:.2f} с запросов; запрос в loop блокирует на {blocking * 1000:.0f} мс")
+    assert duration > 0.2
+    assert busy_lag < 0.05
+    assert busy_lag < blocking / 4
@@ -0,0 +1,62 @@
+import asyncio
+
+from aiogram.types import Update
+
+
+def press(bot_module, user_id: int, data: str):
+    update = Update.model_validate({'update_id': 1, 'callback_query': {
+        'id': '1', 'chat_instance': '1', 'data': data,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'u'},
+        'message': {'message_id': 1, 'date': 0, 'chat': {'id': user_id, 'type': 'private'}, 'text': 'x'}}})
+    return asyncio.run(bot_module.process_update(update))
+
+
+def test_forged_shop_pages_do_not_grow_keyboard_cache(bot_module, session):
+    for rarity in bot_module.PHONES_DB:
+        for page in range(bot_module.shop_pages(rarity)):
+            bot_module.shop_phones_keyboard(rarity, page)
+    cached = bot_module.shop_phones_keyboard.cache_info().currsize
+    for user_id, data in enumerate(["shop_0_999999", "shop_0_-1", "shop_99", "shop_2_7"], start=30_000):
+        press(bot_module, user_id, data)
+    assert bot_module.shop_phones_keyboard.cache_info().currsize == cached
+    # Чужой номер страницы только гасит часики на кнопке
+    assert [type(request).__name__ for request in session.requests] == ['AnswerCallbackQuery'] * 4
+
+    session.requests.clear()
+    press(bot_module, 30_010, "shop_0_1")
+    assert [type(request).__name__ for request in session.requests] == ['EditMessageText', 'AnswerCallbackQuery']
+    assert bot_module.shop_phones_keyboard.cache_info().currsize == cached
+
+
+def test_sellall_targets_share_one_cached_keyboard(bot_module, session):
+    async def give_phone():
+        await bot_module.create_user(30_100, 'seller', 'u')
+        await bot_module.db.write(bot_module.insert_phone, 30_100, bot_module.MODELS[1])
+
+    asyncio.run(give_phone())
+    bot_module.sellall_confirm_keyboard.cache_clear()
+    for data in ("sellall_0", "sellall_00", "sellall_000", "sellall_42"):
+        press(bot_module, 30_100, data)
+    assert bot_module.sellall_confirm_keyboard.cache_info().currsize == 1
+    edits = [request for request in session.requests if type(request).__name__ == 'EditMessageText']
+    assert len(edits) == 3
+    assert {edit.reply_markup.inline_keyboard[0][0].callback_data for edit in edits} == {"sellallok_0"}
+
+
+def test_old_format_buy_buttons_are_not_read_as_model_ids(bot_module, session):
+    async def rich_player():
+        await bot_module.create_user(30_200, 'rich', 'u')
+        await bot_module.db.write(bot_module.change_balance, 30_200, 10 ** 9)
+
+    asyncio.run(rich_player())
+    model = next(model for model in bot_module.MODELS.values() if not model.retired)
+    stale = [f"buy_{model.id}_Apple iPhone X", f"confirm_buy_{model.id}_Apple iPhone 13 Pro",
+             f"confirm_buy_{model.id}_", "confirm_buy_²", f"buy_-{model.id}"]
+    for data in stale:
+        press(bot_module, 30_200, data)
+    answers = [request for request in session.requests if type(request).__name__ == 'AnswerCallbackQuery']
+    assert [answer.text for answer in answers] == ["❌ Этот телефон больше не продаётся!"] * len(stale)
+    assert len(session.requests) == len(stale)
+    owned = asyncio.run(bot_module.db.read(
+        lambda conn: conn.execute('SELECT COUNT(*) FROM user_phones WHERE user_id = 30200').fetchone()[0]))
+    assert owned == 0
@@ -0,0 +1,83 @@
+import asyncio
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile
+
+from conftest import make_message
+
+
+def photo_message(file_id: str):
+    return make_message(photo=[{'file_id': file_id, 'file_unique_id': file_id, 'width': 90, 'height': 90}])
+
+
+def test_file_id_is_stored_and_reused(bot_module, session, tmp_path):
+    cache = bot_module.MediaCache({'logo': (str(tmp_path / 'missing.jpg'), 'https://example.com/logo.jpg')})
+    session.responder = lambda method: photo_message('F1')
+
+    async def scenario():
+        await cache.load()
+        await cache.send_photo(bot_module.bot, 1, 'logo', caption='hi')
+        await cache.send_photo(bot_module.bot, 2, 'logo')
+        restored = bot_module.MediaCache(cache.media)
+        await restored.load()
+        return restored
+
+    restored = asyncio.run(scenario())
+    first, second = session.requests
+    # Локального файла нет - первая отправка идёт по URL, дальше только file_id
+    assert first.photo == 'https://example.com/logo.jpg'
+    assert first.caption == 'hi'
+    assert second.photo == 'F1'
+    # file_id пережил "перезапуск": новый кэш прочитал его из базы
+    assert restored._file_ids['logo'] == 'F1'
+
+
+def test_rejected_file_id_falls_back_to_upload(bot_module, session, tmp_path):
+    local = tmp_path / 'banner.jpg'
+    local.write_bytes(b'\xff\xd8\xff')
+    cache = bot_module.MediaCache({'banner': (str(local), 'https://example.com/banner.jpg')})
+
+    def responder(method):
+        if method.photo == 'OLD':
+            raise TelegramBadRequest(method=method, message='Bad Request: wrong file identifier')
+        return photo_message('NEW')
+
+    session.responder = responder
+
+    async def scenario():
+        await bot_module.save_media_file_id('banner', 'OLD')
+        await cache.load()
+        await cache.send_photo(bot_module.bot, 1, 'banner')
+        return await bot_module.load_media_file_ids()
+
+    stored = asyncio.run(scenario())
+    rejected, uploaded = session.requests
+    assert rejected.photo == 'OLD'
+    # Отклонённый id забыт, загружен локальный файл, запомнен новый id
+    assert isinstance(uploaded.photo, FSInputFile)
+    assert uploaded.photo.path == str(local)
+    assert stored['banner'] == 'NEW'
+    assert cache._file_ids['banner'] == 'NEW'
+
+
+def test_rejected_file_id_is_forgotten_when_upload_fails(bot_module, session, tmp_path):
+    cache = bot_module.MediaCache({'card': (str(tmp_path / 'missing.jpg'), 'https://example.com/card.jpg')})
+
+    def responder(method):
+        raise TelegramBadRequest(method=method, message='Bad Request: wrong file identifier')
+
+    session.responder = responder
+
+    async def scenario():
+        await bot_module.save_media_file_id('card', 'STALE')
+        await cache.load()
+        try:
+            await cache.send_photo(bot_module.bot, 1, 'card')
+        except TelegramBadRequest:
+            pass
+        return await bot_module.load_media_file_ids()
+
+    stored = asyncio.run(scenario())
+    assert [request.photo for request in session.requests] == ['STALE', 'https://example.com/card.jpg']
+    assert 'card' not in stored
+    assert 'card' not in cache._file_ids
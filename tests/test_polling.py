@@ -0,0 +1,45 @@
+import asyncio
+import signal
+
+from aiogram.types import Update
+
+from conftest import StubSession, default_response
+
+
+class PollingSession(StubSession):
+    """Первый getUpdates отдаёт updates, следующий присылает процессу SIGTERM"""
+
+    def __init__(self, updates):
+        super().__init__()
+        self.batches = [updates]
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests.append(method)
+        if type(method).__name__ != 'GetUpdates':
+            return default_response(method)
+        if self.batches:
+            return self.batches.pop(0)
+        if method.timeout:
+            signal.raise_signal(signal.SIGTERM)
+        return []
+
+
+def test_polling_sends_answers_returned_by_handlers(bot_module):
+    update = Update.model_validate({'update_id': 7, 'callback_query': {
+        'id': '77', 'chat_instance': '1', 'data': 'confirm_buy_%d' % max(bot_module.MODELS),
+        'from': {'id': 50_000, 'is_bot': False, 'first_name': 'u'},
+        'message': {'message_id': 1, 'date': 0, 'chat': {'id': 50_000, 'type': 'private'}, 'text': 'x'}}})
+    original = bot_module.bot.session
+    bot_module.bot.session = session = PollingSession([update])
+    try:
+        asyncio.run(bot_module.create_user(50_000, 'poor', 'u'))
+        asyncio.run(bot_module.run_polling())
+    finally:
+        bot_module.bot.session = original
+
+    answers = [request for request in session.requests if type(request).__name__ == 'AnswerCallbackQuery']
+    # Денег на самый дорогой телефон нет: алерт должен дойти до клиента
+    assert [(answer.callback_query_id, answer.show_alert) for answer in answers] == [('77', True)]
+    assert answers[0].text.startswith("❌ Недостаточно ТОчек!")
+    # После остановки запущенный апдейт подтверждён
+    assert session.requests[-1].offset == 8
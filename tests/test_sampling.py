@@ -0,0 +1,64 @@
+import random
+from fractions import Fraction
+
+import pytest
+
+SAMPLES = 200_000
+
+
+def alias_probabilities(sampler):
+    """Точные вероятности редкостей, посчитанные по alias-таблице: колонка i выбирает
+    себя с долей threshold[i] / total, остальное отдаёт alias[i]"""
+    columns = len(sampler.rarities)
+    mass = [0] * columns
+    for column, (threshold, alias) in enumerate(zip(sampler._threshold, sampler._alias)):
+        mass[column] += threshold
+        mass[alias] += sampler.total - threshold
+    return {rarity: Fraction(mass[column], columns * sampler.total)
+            for column, rarity in enumerate(sampler.rarities)}
+
+
+def configured_probabilities(rarities):
+    """Шансы из настроек: недостающие до 100% достаются низшей редкости"""
+    chances = {rarity: Fraction(str(settings['chance'])) for rarity, settings in rarities.items()}
+    chances[min(chances)] += max(0, 100 - sum(chances.values()))
+    total = sum(chances.values())
+    return {rarity: chance / total for rarity, chance in chances.items()}
+
+
+@pytest.mark.parametrize('chances', [
+    None,
+    [40, 30, 15, 8, 5, 1.8, 0.19, 0.01],
+    [33.3, 33.3, 0.07, 0.003],
+    [10, 20],
+    [97, 1, 1, 1],
+])
+def test_alias_table_matches_configured_chances_exactly(bot_module, chances):
+    rarities = bot_module.RARITIES if chances is None else {
+        rarity: {'chance': chance} for rarity, chance in enumerate(chances)}
+    sampler = bot_module.PhoneSampler(rarities, {})
+    assert alias_probabilities(sampler) == configured_probabilities(rarities)
+
+
+def test_live_drop_rates(bot_module):
+    random.seed(20240501)
+    assert bot_module.check_drop_rates(SAMPLES)
+
+
+def test_drop_rate_check_catches_wrong_chances(bot_module, monkeypatch):
+    # Шансы двух нижних редкостей перепутаны: проверка обязана это заметить
+    swapped = {rarity: dict(settings) for rarity, settings in bot_module.RARITIES.items()}
+    swapped[0]['chance'], swapped[1]['chance'] = swapped[1]['chance'], swapped[0]['chance']
+    monkeypatch.setattr(bot_module, 'sampler', bot_module.PhoneSampler(swapped, bot_module.PHONES_DB))
+    random.seed(20240501)
+    assert not bot_module.check_drop_rates(SAMPLES)
+
+
+def test_vectorized_draws_follow_the_same_table(bot_module):
+    np = pytest.importorskip('numpy')
+    sampler = bot_module.sampler
+    columns, _ = sampler.draw_arrays(SAMPLES, np.random.default_rng(20240501))
+    observed = np.bincount(columns, minlength=len(sampler.rarities))
+    expected = [SAMPLES * float(p) for p in alias_probabilities(sampler).values()]
+    df = len(sampler.rarities) - 1
+    assert bot_module._chi2(observed, expected) <= bot_module._chi2_critical(df)
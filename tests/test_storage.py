@@ -0,0 +1,74 @@
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.types import Update
+
+
+def count_loads(bot_module, monkeypatch):
+    """Подменяет load_fsm_record счётчиком; возвращает список ключей прочитанных записей"""
+    loads = []
+    original = bot_module.load_fsm_record
+
+    async def counting(key, known_version=-1):
+        loads.append(key)
+        return await original(key, known_version)
+
+    monkeypatch.setattr(bot_module, 'load_fsm_record', counting)
+    return loads
+
+
+def storage_key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=42, chat_id=user_id, user_id=user_id)
+
+
+def test_cached_reads_do_not_touch_the_database(bot_module, monkeypatch):
+    loads = count_loads(bot_module, monkeypatch)
+    storage = bot_module.SQLiteStorage(revalidate=60)
+    written, missing = storage_key(60_000), storage_key(60_001)
+
+    async def scenario():
+        await storage.set_state(written, 'Form:name')
+        await storage.set_data(written, {'step': 1})
+        for _ in range(10):
+            assert await storage.get_state(written) == 'Form:name'
+            assert await storage.get_data(written) == {'step': 1}
+            assert await storage.get_state(missing) is None
+            assert await storage.get_data(missing) == {}
+
+    asyncio.run(scenario())
+    # Записанное этим процессом уже в кэше, отсутствие записи прочитано один раз
+    assert loads == [storage._key(missing)]
+
+
+def test_other_process_changes_are_seen_after_revalidate(bot_module, monkeypatch):
+    loads = count_loads(bot_module, monkeypatch)
+    ours, theirs = bot_module.SQLiteStorage(revalidate=0.2), bot_module.SQLiteStorage()
+    key = storage_key(60_100)
+
+    async def scenario():
+        await ours.set_state(key, 'Form:name')
+        await theirs.set_state(key, 'Form:age')
+        stale = await ours.get_state(key)
+        await asyncio.sleep(0.25)
+        return stale, await ours.get_state(key)
+
+    # Устаревание ограничено revalidate: после него сверяется версия и запись перечитывается
+    assert asyncio.run(scenario()) == ('Form:name', 'Form:age')
+    assert len(loads) == 1
+
+
+def test_chatter_costs_one_fsm_read(bot_module, session, monkeypatch):
+    loads = count_loads(bot_module, monkeypatch)
+    monkeypatch.setattr(bot_module.storage, 'revalidate', 60)
+
+    async def chatter():
+        for update_id in range(20):
+            update = Update.model_validate({'update_id': update_id, 'message': {
+                'message_id': update_id, 'date': 0, 'text': 'привет всем',
+                'chat': {'id': -100, 'type': 'group', 'title': 'g'},
+                'from': {'id': 60_200, 'is_bot': False, 'first_name': 'u'}}})
+            await bot_module.process_update(update)
+
+    asyncio.run(chatter())
+    # FSMContextMiddleware спрашивает состояние на каждый апдейт, включая срезанные антифлудом
+    assert len(loads) == 1
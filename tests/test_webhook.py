@@ -0,0 +1,112 @@
+import asyncio
+import copy
+import json
+import os
+import time
+
+from aiogram import F, Router
+from aiohttp import MultipartReader, web
+from aiohttp.test_utils import TestClient, TestServer
+
+RECORDED = os.path.join(os.path.dirname(__file__), 'data', 'updates.json')
+PLAYERS = 100
+
+
+def recorded_updates(players: int):
+    """Записанные апдейты, размноженные на players игроков с уникальными update_id"""
+    with open(RECORDED, encoding='utf-8') as f:
+        template = json.load(f)
+    updates = []
+    for player in range(players):
+        user_id = 10_000 + player
+        for update in copy.deepcopy(template):
+            event = update.get('message') or update['callback_query']
+            event['from']['id'] = user_id
+            chat = event['chat'] if 'chat' in event else event['message']['chat']
+            chat['id'] = user_id
+            if 'callback_query' in update:
+                update['callback_query']['id'] = str(len(updates))
+            update['update_id'] = len(updates) + 1
+            updates.append(update)
+    return updates
+
+
+async def serve(handler_factory, scenario):
+    app = web.Application()
+    handler = handler_factory()
+    handler.register(app, path='/webhook')
+    async with TestClient(TestServer(app)) as client:
+        return await scenario(client, handler)
+
+
+async def answered_method(response):
+    """Имя метода API, отправленного в теле ответа вебхука, или None"""
+    if not response.content_type.startswith('multipart/'):
+        return None
+    reader = MultipartReader.from_response(response)
+    while (part := await reader.next()) is not None:
+        if part.name == 'method':
+            return await part.text()
+    return None
+
+
+def bounded_handler(bot_module, **kwargs):
+    options = dict(max_concurrency=16, max_pending=1024)
+    options.update(kwargs)
+    return lambda: bot_module.BoundedRequestHandler(bot_module.dp, bot_module.bot, **options)
+
+
+def test_recorded_updates_throughput(bot_module, session):
+    updates = recorded_updates(PLAYERS)
+
+    async def scenario(client, handler):
+        for player in range(PLAYERS):
+            await bot_module.create_user(10_000 + player, 'player', 'Игрок')
+        started = time.perf_counter()
+        responses = await asyncio.gather(*(client.post('/webhook', json=update) for update in updates))
+        elapsed = time.perf_counter() - started
+        methods = [await answered_method(response) for response in responses]
+        return [response.status for response in responses], methods, elapsed
+
+    statuses, methods, elapsed = asyncio.run(serve(bounded_handler(bot_module), scenario))
+    print(f"\n{len(updates)} апдейтов за {elapsed:.2f} с: {len(updates) / elapsed:.0f} апдейтов/с, "
+          f"{len(session.requests)} запросов к API")
+    assert statuses == [200] * len(updates)
+    # Ответ на нажатие кнопки уходит в теле ответа вебхука, а не отдельным запросом
+    assert methods.count('answerCallbackQuery') == 2 * PLAYERS
+    assert not any(type(request).__name__ == 'AnswerCallbackQuery' for request in session.requests)
+
+
+def test_handler_error_is_answered_with_200(bot_module, session):
+    router = Router()
+
+    @router.callback_query(F.data == 'explode')
+    async def explode(callback):
+        raise RuntimeError("boom")
+
+    bot_module.dp.include_router(router)
+    update = {'update_id': 1, 'callback_query': {'id': '1', 'chat_instance': '1', 'data': 'explode',
+                                                 'from': {'id': 20_000, 'is_bot': False, 'first_name': 'u'}}}
+
+    async def scenario(client, handler):
+        response = await client.post('/webhook', json=update)
+        return response.status, await response.json(), handler.failed
+
+    try:
+        status, body, failed = asyncio.run(serve(bounded_handler(bot_module), scenario))
+    finally:
+        bot_module.dp.sub_routers.remove(router)
+    # 500 заставил бы Telegram повторить апдейт и выполнить записи хендлера ещё раз
+    assert (status, body, failed) == (200, {}, 1)
+
+
+def test_draining_handler_answers_503(bot_module, session):
+    update = recorded_updates(1)[0]
+
+    async def scenario(client, handler):
+        handler.draining = True
+        response = await client.post('/webhook', json=update)
+        return response.status, handler.rejected
+
+    assert asyncio.run(serve(bounded_handler(bot_module), scenario)) == (503, 1)
+    assert session.requests == []